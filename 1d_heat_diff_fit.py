@@ -1,195 +1,903 @@
 import numpy as np
 from scipy.optimize import minimize
 from scipy.optimize import curve_fit
+from scipy.optimize import brentq
+from scipy.stats import chi2
+from scipy.linalg import lapack
+from scipy.fft import dct, idct
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 import os
 import math
 import re
+import traceback
+import itertools
+import time
+import hashlib
+import json
+
+from kymograph_arrays import bundle_path, read_kymograph, remove_bundle, write_bundle
 
 initial_diffusion_coef = 1e-13
+solver = 'crank-nicolson'     # 'crank-nicolson' (time stepping) or 'spectral' (exact in time, cosine transform)
+tolerance = None              # None takes one Crank-Nicolson step per frame interval, a value (e.g. 1e-4) sub-steps every interval until
+                              # the estimated error (step doubling) relative to the largest value of the profile is below it
+max_substeps = 1024           # upper limit of the Crank-Nicolson sub-steps of one frame interval
+time_resolution = 1e-3        # s, Crank-Nicolson steps between timestamps rounded to this clock, so jittered frame intervals repeat
+                              # exactly and share their factorization, None steps the measured intervals
+workers = os.cpu_count()      # number of processes fitting cells in parallel, 1 fits all cells one after another
+summary = 'directory'         # 'directory' writes diffusion-coefficients.csv per directory, 'global' one for the whole tree
+incremental = True            # only fit cells whose kymograph or fit settings changed since the last run (see fit-manifest.json)
+fit_version = 2               # increase when the fitting changes, this invalidates all manifests
+storage = 'csv'               # 'csv' writes csv files, 'binary' a memory mappable .npy bundle per cell (<cell>-arrays), 'both' both
+high_resolution = True        # also simulate at a higher resolution, not needed when only the coefficients are of interest
+high_res_x_factor = 2         # spatial upsampling of the high resolution simulation
+high_res_t_factor = 1         # temporal upsampling of the high resolution simulation (of the median frame interval)
+uncertainty = None            # None, 'bootstrap' (refit resampled residuals) or 'profile' (profile likelihood) confidence interval of D
+confidence_level = 0.95
+bootstrap_samples = 200       # number of refits per cell for the bootstrap
+grid_chunk = 16               # diffusion coefficients of a grid (bootstrap, profile) simulated together, limits the memory per cell
+dtype = 'float64'             # 'float32' holds kymographs, simulations and residuals in single precision (half the memory), the
+                              # solvers still step in double precision
+metrics = False               # write per cell stage timings and fit diagnostics to fit-metrics.csv (next to diffusion-coefficients.csv)
 #path = 'g:\\My Drive\\Data\\PyCharmProjects\\New FRAP analysis software\\20181212_002\\test metabolic\\20181206\\'
 path = os.getcwd()
 # https://pycav.readthedocs.io/en/latest/api/pde/crank_nicolson.html
 # https://www.quantstart.com/articles/Crank-Nicholson-Implicit-Scheme
-def crank_nicolson(initial_heat: np.array, delta_x: float, delta_t: float, diffusion_coef: float):
+@lru_cache(maxsize=1024)
+def factorize(r, n: int):
+    """
+    LU factorizes the tridiagonal left hand side of the Crank-Nicolson scheme. Only the three diagonals are stored
+    and the factorization is cached on (r, n), time steps of the same size reuse it (see frame_intervals).
+    r can also be a tuple, one value for each system in a stack of k independent systems. These are factorized as one
+    tridiagonal system of size k * n without coupling between the blocks (cached separately, see factorize_stack).
+    """
+    rs = np.reshape(r, (-1, 1))
+    lower = np.repeat(-rs / 2.0, n, axis=1)
+    diagonal = np.repeat(1.0 + rs, n, axis=1)
+    upper = lower.copy()
+
+    # no flux boundaries
+    upper[:, 0] *= 2
+    lower[:, -2] *= 2
+
+    # no coupling between stacked systems
+    lower[:, -1] = 0
+    upper[:, -1] = 0
+
+    lower, diagonal, upper, upper2, pivots, info = lapack.dgttrf(lower.ravel()[:-1], diagonal.ravel(), upper.ravel()[:-1])
+    return lower, diagonal, upper, upper2, pivots
+
+
+# stacks are k times larger and a grid of coefficients rarely repeats, only the stacks of the last few time steps are kept
+factorize_stack = lru_cache(maxsize=16)(factorize.__wrapped__)
+
+
+def laplacian(heat: np.array):
+    """
+    Second difference along the last axis of heat, with no flux (reflecting) boundaries.
+    """
+    d = -2.0 * heat
+    d[..., 1:-1] += heat[..., :-2] + heat[..., 2:]
+    d[..., :1] += 2.0 * heat[..., 1:2]
+    d[..., -1:] += 2.0 * heat[..., -2:-1]
+    return d
 
-    A = np.zeros([len(initial_heat), len(initial_heat)])
 
+def explicit_step(heat: np.array, r):
+    """
+    The right hand side of the Crank-Nicolson scheme (with no flux boundaries), along the last axis of heat.
+    """
+    return heat + r / 2.0 * laplacian(heat)
+
+
+def crank_nicolson(initial_heat: np.array, delta_x: float, delta_t: float, diffusion_coef: float):
+
+    initial_heat = np.asarray(initial_heat, dtype=float)
     r = diffusion_coef * delta_t / (delta_x * delta_x)
-    a = -r / 2.0
-    b = 1.0 + r
-    c = -r / 2.0
 
-    np.fill_diagonal(A[:,1:], a)
-    np.fill_diagonal(A, b)
-    np.fill_diagonal(A[1:], c)
+    lower, diagonal, upper, upper2, pivots = factorize(r, len(initial_heat))
+    after, info = lapack.dgttrs(lower, diagonal, upper, upper2, pivots, explicit_step(initial_heat, r))
+
+    return after
+
+
+def crank_nicolson_stack(initial_heats: np.array, delta_x: float, delta_t: float, diffusion_coefs: np.array):
+    """
+    One Crank-Nicolson step for a k x n stack of profiles, each with its own diffusion coefficient.
+    All k systems are solved together in one tridiagonal solve.
+    """
+    r = np.asarray(diffusion_coefs, dtype=float) * delta_t / (delta_x * delta_x)
+
+    if len(r) == 1:
+        lower, diagonal, upper, upper2, pivots = factorize(float(r[0]), initial_heats.shape[1])
+    else:
+        lower, diagonal, upper, upper2, pivots = factorize_stack(tuple(r), initial_heats.shape[1])
+    after, info = lapack.dgttrs(lower, diagonal, upper, upper2, pivots, explicit_step(initial_heats, r[:, None]).ravel())
 
-    A[0, 1] *= 2
-    A[-1, -2] *= 2
+    return after.reshape(initial_heats.shape)
 
-    D = np.zeros(len(initial_heat))
-    for i in range(1, len(initial_heat) - 1):
-        D[i] = r / 2.0 * initial_heat[i - 1] + (1.0 - r) * initial_heat[i] + r / 2.0 * initial_heat[i + 1]
-    D[0] = (1.0 - r) * initial_heat[0] + r * initial_heat[1]
-    D[-1] = (1.0 - r) * initial_heat[-1] + r * initial_heat[-2]
 
-    return np.linalg.solve(A, D)
+# simulations of the current cell (a batch simulation of k coefficients is one call), its Crank-Nicolson steps (including
+# the steps step doubling rejects) and the largest number of sub-steps of one frame interval, reset by analyze
+solver_counts = {'solver_calls': 0, 'time_steps': 0, 'max_substeps': 0}
 
 
-def simulation(initial_heat, delta_x, timestamps, diffusion_coef):
+def crank_nicolson_steps(initial_heats: np.array, delta_x: float, delta_t: float, diffusion_coefs: np.array, steps: int):
+    """
+    Integrates one frame interval of a k x n stack of profiles with a number of equal Crank-Nicolson steps, which all
+    use the same (cached) factorization.
+    """
+    heats = initial_heats
+    for _ in range(steps):
+        heats = crank_nicolson_stack(heats, delta_x, delta_t / steps, diffusion_coefs)
 
-    after = initial_heat.copy()
-    simulated_values = after
+    solver_counts['time_steps'] += steps
+    return heats
 
-    # calculate delta t's
-    delta_ts = [t1 - t0 for t0, t1 in zip(timestamps[:-1], timestamps[1:])]
 
-    for delta_t in delta_ts:
-        # delta_x from micro meter to meter
+def substep_error(fine: np.array, coarse: np.array):
+    """
+    The error of the finer of two step doubling solutions relative to the allowed error (at most 1 is accurate enough):
+    their difference divided by 3 (the scheme is second order), relative to tolerance times the largest value.
+    """
+    return np.abs(fine - coarse).max() / 3 / (tolerance * np.abs(fine).max())
+
+
+def adaptive_crank_nicolson(initial_heats: np.array, delta_x: float, delta_t: float, diffusion_coefs: np.array, steps: int = 1):
+    """
+    Sub-steps one frame interval of a k x n stack of profiles to tolerance with step doubling. The interval is
+    integrated with steps and with 2 * steps steps, their difference (divided by 3, the scheme is second order)
+    estimates the error of the finer solution. The number of steps is doubled until this error is below tolerance
+    times the largest value of the profiles, or max_substeps is reached.
+    Returns the finer solution and its number of steps.
+    """
+    coarse = crank_nicolson_steps(initial_heats, delta_x, delta_t, diffusion_coefs, steps)
+
+    while True:
+        steps *= 2
+        fine = crank_nicolson_steps(initial_heats, delta_x, delta_t, diffusion_coefs, steps)
+
+        if substep_error(fine, coarse) <= 1 or steps >= max_substeps:
+            solver_counts['max_substeps'] = max(solver_counts['max_substeps'], steps)
+            return fine, steps
+
+        coarse = fine
+
+
+def frame_intervals(timestamps):
+    """
+    The time steps between the timestamps. Measured timestamps jitter, so no two intervals would be equal and every
+    step would need its own factorization. The timestamps are rounded to time_resolution first, the intervals are
+    then whole numbers of clock ticks and repeat exactly (the rounding error doesn't add up over the frames).
+    """
+    if time_resolution is None:
+        return np.diff(timestamps)
+
+    return np.diff(np.round(np.asarray(timestamps, dtype=float) / time_resolution)) * time_resolution
+
+
+def sensitivity_steps(initial_heat: np.array, initial_sensitivity: np.array, delta_x: float, delta_t: float, diffusion_coef: float, steps: int):
+    """
+    Integrates one frame interval of a profile together with its derivative with respect to the diffusion coefficient
+    (see simulation_sensitivity, delta_x in meter), with a number of equal steps that share one (cached) factorization.
+    """
+    delta_t = delta_t / steps
+    r = diffusion_coef * delta_t / (delta_x * delta_x)
+    lower, diagonal, upper, upper2, pivots = factorize(r, len(initial_heat))
+    heat, sensitivity = initial_heat, initial_sensitivity
+
+    for _ in range(steps):
+        after, info = lapack.dgttrs(lower, diagonal, upper, upper2, pivots, explicit_step(heat, r))
+
+        rhs = explicit_step(sensitivity, r)
+        rhs += delta_t / (2.0 * delta_x * delta_x) * laplacian(heat + after)
+        sensitivity, info = lapack.dgttrs(lower, diagonal, upper, upper2, pivots, rhs)
+        heat = after
+
+    solver_counts['time_steps'] += steps
+    return heat, sensitivity
+
+
+def cosine_eigenvalues(n: int, delta_x: float):
+    """
+    Eigenvalues of the (negative) no flux Laplacian of n points, the eigenvectors are the type 1 cosine transform basis.
+    """
+    return (2.0 * np.sin(np.pi * np.arange(n) / (2.0 * (n - 1))) / delta_x) ** 2
+
+
+def spectral_simulation(initial_heat, delta_x, timestamps, diffusion_coefs):
+    """
+    Solves the same no flux diffusion model exactly in time. The discrete Laplacian with reflecting boundaries is
+    diagonalized by the type 1 cosine transform, each mode decays as exp(-D * eigenvalue * t). The initial profile is
+    transformed once and every frame is evaluated directly at its timestamp, so irregular frame intervals cost nothing
+    extra and there is no time discretization error.
+    Returns a k x t x n array (coefficients x timestamps x positions) of dtype.
+    """
+    diffusion_coefs = np.atleast_1d(np.asarray(diffusion_coefs, dtype=float))
+    initial_heat = np.asarray(initial_heat, dtype=float)
+    timestamps = np.asarray(timestamps, dtype=float)
+    n = len(initial_heat)
+
+    # delta_x from micro meter to meter
+    eigenvalues = cosine_eigenvalues(n, delta_x / 1e6)
+    modes = dct(initial_heat, type=1)
+
+    decay = np.exp(-diffusion_coefs[:, None, None] * (timestamps - timestamps[0])[None, :, None] * eigenvalues)
+    return idct(modes * decay, type=1, axis=-1).astype(dtype, copy=False)
+
+
+def simulation(initial_heat, delta_x, timestamps, diffusion_coef, solver='crank-nicolson'):
+    """
+    Simulates the initial profile at every timestamp.
+    Returns a t x n array (timestamps x positions) of dtype.
+    """
+    if solver == 'crank-nicolson' and tolerance is not None:
+        return batch_simulation(initial_heat, delta_x, timestamps, [diffusion_coef], solver)[0]
+
+    solver_counts['solver_calls'] += 1
+
+    if solver == 'spectral':
+        return spectral_simulation(initial_heat, delta_x, timestamps, diffusion_coef)[0]
+    elif solver != 'crank-nicolson':
+        raise ValueError('unknown solver \'%s\'' % solver)
+
+    after = np.asarray(initial_heat, dtype=float)
+    simulated_values = np.empty((len(timestamps), len(after)), dtype=dtype)
+    simulated_values[0] = after
+
+    for i, delta_t in enumerate(frame_intervals(timestamps)):
+        # delta_x from micro meter to meter, the steps continue from the double precision profile
         after = crank_nicolson(after, delta_x / 1e6, delta_t, diffusion_coef)
-        simulated_values.extend(after.tolist())
+        simulated_values[i + 1] = after
+
+    solver_counts['time_steps'] += len(timestamps) - 1
 
     return simulated_values
 
 
+def batch_simulation(initial_heat, delta_x, timestamps, diffusion_coefs, solver='crank-nicolson'):
+    """
+    Simulates the same initial profile for k diffusion coefficients at once.
+    Returns a k x t x n array (coefficients x timestamps x positions) of dtype.
+    """
+    solver_counts['solver_calls'] += 1
+
+    if solver == 'spectral':
+        return spectral_simulation(initial_heat, delta_x, timestamps, diffusion_coefs)
+    elif solver != 'crank-nicolson':
+        raise ValueError('unknown solver \'%s\'' % solver)
+
+    diffusion_coefs = np.atleast_1d(np.asarray(diffusion_coefs, dtype=float))
+    heats = np.repeat(np.asarray(initial_heat, dtype=float)[None], len(diffusion_coefs), axis=0)
+
+    simulated_values = np.empty((len(diffusion_coefs), len(timestamps), heats.shape[1]), dtype=dtype)
+    simulated_values[:, 0] = heats
+
+    steps = 1
+    for i, delta_t in enumerate(frame_intervals(timestamps)):
+        # delta_x from micro meter to meter, the steps continue from the double precision profiles
+        if tolerance is None:
+            heats = crank_nicolson_steps(heats, delta_x / 1e6, delta_t, diffusion_coefs, 1)
+        else:
+            # start from a quarter of the steps of the previous interval, so the number of steps can also decrease
+            heats, steps = adaptive_crank_nicolson(heats, delta_x / 1e6, delta_t, diffusion_coefs, max(steps // 4, 1))
+
+        simulated_values[:, i + 1] = heats
+
+    return simulated_values
+
+
+def simulation_sensitivity(initial_heat, delta_x, timestamps, diffusion_coef, solver='crank-nicolson'):
+    """
+    Simulates the profile together with its derivative with respect to the diffusion coefficient.
+    For Crank-Nicolson the derivative follows the tangent linear recursion
+        A s[i + 1] = B s[i] + delta_t / (2 delta_x^2) L (u[i] + u[i + 1])
+    which reuses the factorization of A, for the spectral solver each mode is simply multiplied by -eigenvalue * t.
+    Returns two t x n arrays (simulated values and derivative).
+    """
+    initial_heat = np.asarray(initial_heat, dtype=float)
+    timestamps = np.asarray(timestamps, dtype=float)
+    n = len(initial_heat)
+    solver_counts['solver_calls'] += 1
+
+    # delta_x from micro meter to meter
+    delta_x = delta_x / 1e6
+
+    if solver == 'spectral':
+        eigenvalues = cosine_eigenvalues(n, delta_x)
+        modes = dct(initial_heat, type=1)
+        exponent = -(timestamps - timestamps[0])[:, None] * eigenvalues
+        decay = modes * np.exp(diffusion_coef * exponent)
+        return idct(decay, type=1, axis=-1), idct(decay * exponent, type=1, axis=-1)
+    elif solver != 'crank-nicolson':
+        raise ValueError('unknown solver \'%s\'' % solver)
+
+    simulated_values = np.empty((len(timestamps), n))
+    derivative = np.empty((len(timestamps), n))
+    simulated_values[0] = initial_heat
+    derivative[0] = 0.0
+
+    steps = 1
+    for i, delta_t in enumerate(frame_intervals(timestamps)):
+        if tolerance is None:
+            simulated_values[i + 1], derivative[i + 1] = sensitivity_steps(simulated_values[i], derivative[i], delta_x, delta_t, diffusion_coef, 1)
+            continue
+
+        # step doubling on the profile: the coarse solution is the profile alone, the finer one is integrated together
+        # with the derivative, so the accepted solution is used as it is
+        coarse = crank_nicolson_steps(simulated_values[i][None], delta_x, delta_t, [diffusion_coef], steps)[0]
+
+        while True:
+            heat, sensitivity = sensitivity_steps(simulated_values[i], derivative[i], delta_x, delta_t, diffusion_coef, 2 * steps)
+            error = substep_error(heat, coarse)
+
+            if error <= 1 or 2 * steps >= max_substeps:
+                break
+
+            coarse, steps = heat, 2 * steps
+
+        simulated_values[i + 1], derivative[i + 1] = heat, sensitivity
+        solver_counts['max_substeps'] = max(solver_counts['max_substeps'], 2 * steps)
+
+        # the error is second order in the step: the next interval starts from the (coarse) steps this error asks for,
+        # with a margin, so the finer solution is mostly accepted at once and the number of steps can also decrease
+        steps = min(max(int(math.ceil(1.2 * steps * math.sqrt(error))), 1), max_substeps // 2)
+
+    return simulated_values, derivative
+
 
 def open_csv(path):
+    """
+    Reads a kymograph (-values.csv) in one pass of the NumPy parser.
+    Returns delta_x, the timestamps (starting from 0) and the values (a contiguous t x n array of dtype).
+    """
     with open(path, 'r') as f:
-        lines = f.readlines()
-        delta_x = float(lines[0].split(',')[2])
-        timestamps = [float(line.split(',')[0]) for line in lines[1:]]
-        values = [[float(col) for col in line.strip().split(',')[1:]] for line in lines[1:]]
+        delta_x = float(f.readline().split(',')[2])
+        table = np.loadtxt(f, delimiter=',', ndmin=2)
+
+    # timestamps start from 0
+    timestamps = table[:, 0] - table[0, 0]
+    return delta_x, timestamps, np.ascontiguousarray(table[:, 1:], dtype=dtype)
+
+
+def values_source(path):
+    """
+    The file a kymograph (-values.csv) is read from: its binary bundle when that is at least as recent as the csv file
+    and stored with dtype, otherwise the csv file. A single precision bundle would round a double precision fit.
+    """
+    array_path = os.path.join(bundle_path(path[:-11]), 'values.npy')
+
+    if os.path.exists(array_path) and os.path.getmtime(array_path) >= os.path.getmtime(path) and np.load(array_path, mmap_mode='r').dtype == dtype:
+        return array_path
+
+    return path
+
+
+def open_values(path):
+    """
+    Reads a kymograph (-values.csv), from its binary bundle when possible (see values_source).
+    """
+    if values_source(path) != path:
+        distance, timestamps, values = read_kymograph(path[:-11], 'values')
 
-        # timestamps start from 0
-        timestamps = [t - timestamps[0] for t in timestamps]
-        return delta_x, timestamps, values
+        # copied out of the memory map, the bundle is rewritten after the fit
+        return float(distance[1]), np.array(timestamps, dtype=float), np.array(values, dtype=dtype)
 
+    return open_csv(path)
 
-def fit(values, delta_x, timestamps):
 
-    # flatten all values (necessary for curve_fit function)
-    all_values = [item for sublist in values for item in sublist]
+def fit(values, delta_x, timestamps, solver='crank-nicolson', metrics=None):
 
-    f = lambda xdata, *params: simulation(values[0], delta_x, xdata, params[0])
-    popt, pcov = curve_fit(f, timestamps, all_values, (initial_diffusion_coef,))
+    # flatten all values (necessary for curve_fit function), a view of the contiguous kymograph
+    all_values = values.ravel()
+
+    # the simulation and its derivative are computed together, curve_fit asks for them separately
+    last = dict()
+
+    def evaluate(diffusion_coef):
+        if last.get('diffusion_coef') != diffusion_coef:
+            last['diffusion_coef'] = diffusion_coef
+            last['simulated'], last['derivative'] = simulation_sensitivity(values[0], delta_x, timestamps, diffusion_coef, solver)
+        return last['simulated'], last['derivative']
+
+    f = lambda xdata, *params: evaluate(params[0])[0].ravel()
+    jac = lambda xdata, *params: evaluate(params[0])[1].reshape(-1, 1)
+    popt, pcov, info, message, status = curve_fit(f, timestamps, all_values, (initial_diffusion_coef,), jac=jac, full_output=True)
     perr = np.sqrt(np.diag(pcov))
 
-    return popt[0], perr
+    if metrics is not None:
+        metrics['function_evaluations'] = info['nfev']
+        metrics['jacobian_evaluations'] = info.get('njev', 0)
+
+    return popt[0], perr[0]
+
+
+def sum_of_squares(values, delta_x, timestamps, diffusion_coefs, solver='crank-nicolson'):
+    """
+    Sum of squared residuals for every diffusion coefficient, grid_chunk coefficients at a time are simulated in one
+    batch simulation.
+    """
+    diffusion_coefs = np.atleast_1d(diffusion_coefs)
+    sums = list()
+
+    for i in range(0, len(diffusion_coefs), grid_chunk):
+        simulated = batch_simulation(values[0], delta_x, timestamps, diffusion_coefs[i:i + grid_chunk], solver)
+        sums.append(((simulated - values) ** 2).sum(axis=(1, 2), dtype=float))
+
+    return np.concatenate(sums)
 
 
-# grows a list to double its size
-# [1,2,3,6] => [1,1.5,2,2.5,3,4.5,6]
-def grow(l):
-    for a, b in zip(l[:-1], l[1:]):
-        yield a
-        yield (a + b) / 2
-    yield l[-1]
+def grid_minimum(diffusion_coefs, sums_of_squares):
+    """
+    Refines the minimum of each row of sums_of_squares (on an evenly spaced grid of diffusion coefficients) with a
+    parabola through the smallest value and its neighbours.
+    """
+    k = np.clip(sums_of_squares.argmin(axis=1), 1, len(diffusion_coefs) - 2)
+    rows = np.arange(len(sums_of_squares))
+    left, centre, right = sums_of_squares[rows, k - 1], sums_of_squares[rows, k], sums_of_squares[rows, k + 1]
 
+    h = diffusion_coefs[1] - diffusion_coefs[0]
+    curvature = left - 2.0 * centre + right
+    offset = np.where(curvature > 0, h * (left - right) / (2.0 * np.where(curvature > 0, curvature, 1.0)), 0.0)
 
-def determine_residuals(values1, values2):
-    residuals = list()
+    return diffusion_coefs[k] + np.clip(offset, -h, h)
 
-    for row1, row2 in (zip(values1, values2)):
-        residuals.append([value1 - value2 for value1, value2 in zip(row1, row2)])
 
-    return residuals
+def bootstrap(values, delta_x, timestamps, diffusion_coef, simulated, solver='crank-nicolson', seed=0):
+    """
+    Wild bootstrap of the diffusion coefficient: every sample adds the residuals, each frame with a random sign, to the
+    fitted simulation and is refitted. Residuals stay at their own frame and position, early frames have different
+    residuals than late ones.
+    The refits don't run curve_fit. With y = u + s e (u the fitted simulation, s the signs, e the residuals) the sum of
+    squares of a sample for a simulation v is |u - v|^2 + 2 s (e . (u - v)) + |e|^2 per frame, so all samples are
+    evaluated at once from one batch simulation of a grid of coefficients: first a coarse logarithmic grid, then a fine
+    grid spanning the coarse minima.
+    Returns the lower and upper bound of the confidence interval.
+    """
+    residuals = values - simulated
+    signs = np.random.default_rng(seed).choice([-1.0, 1.0], size=(bootstrap_samples, len(values)))
+
+    def sums_of_squares(diffusion_coefs):
+        # leaves out |e|^2, which is the same for every coefficient, grid_chunk coefficients at a time
+        sums = list()
+
+        for i in range(0, len(diffusion_coefs), grid_chunk):
+            difference = simulated - batch_simulation(values[0], delta_x, timestamps, diffusion_coefs[i:i + grid_chunk], solver)
+            sums.append((difference ** 2).sum(axis=(1, 2), dtype=float) + 2.0 * signs @ np.einsum('ktn,tn->tk', difference, residuals))
+
+        return np.concatenate(sums, axis=1)
+
+    coarse = diffusion_coef * np.logspace(-1, 1, 41)
+    k = sums_of_squares(coarse).argmin(axis=1)
+
+    fine = np.linspace(coarse[max(k.min() - 1, 0)], coarse[min(k.max() + 1, len(coarse) - 1)], 101)
+    estimates = grid_minimum(fine, sums_of_squares(fine))
+
+    return tuple(np.quantile(estimates, [(1.0 - confidence_level) / 2.0, (1.0 + confidence_level) / 2.0]))
+
+
+def profile_likelihood(values, delta_x, timestamps, diffusion_coef, diffusion_coef_error, solver='crank-nicolson'):
+    """
+    Profile likelihood confidence interval of the diffusion coefficient (with normally distributed errors of unknown
+    variance): all D for which m * log(S(D) / S(D_fit)) stays below the chi squared quantile, with S the sum of squared
+    residuals and m the number of values. Each bound is bracketed by stepping away from D_fit, starting with twice the
+    standard error of the fit and doubling the step (within 0 and 10 D_fit), then found with brentq.
+    Returns the lower and upper bound of the confidence interval.
+    """
+    threshold = np.exp(chi2.ppf(confidence_level, 1) / np.size(values))
+    best = sum_of_squares(values, delta_x, timestamps, [diffusion_coef], solver)[0]
+
+    def excess(d):
+        return sum_of_squares(values, delta_x, timestamps, [d], solver)[0] / best - threshold
+
+    step = diffusion_coef_error if 0 < diffusion_coef_error < np.inf else 0.01 * diffusion_coef
+    bounds = list()
+
+    for limit in (0.0, 10.0 * diffusion_coef):
+        inner, distance = diffusion_coef, 2.0 * step
+
+        while True:
+            outer = diffusion_coef + math.copysign(distance, limit - diffusion_coef)
+            outer = max(outer, limit) if limit < diffusion_coef else min(outer, limit)
+
+            if excess(outer) > 0:
+                bounds.append(brentq(excess, min(inner, outer), max(inner, outer), xtol=1e-3 * step))
+                break
+            elif outer == limit:
+                bounds.append(limit)
+                break
+
+            inner, distance = outer, 2.0 * distance
+
+    return tuple(bounds)
+
+
+def resample(values, factor: int):
+    """
+    Linearly interpolates (the rows of) values at factor times the resolution, n points become (n - 1) * factor + 1.
+    [1,2,3,6] => [1,1.5,2,2.5,3,4.5,6] for factor 2
+    """
+    n = values.shape[-1]
+
+    positions = np.arange((n - 1) * factor + 1) / factor
+    left = np.minimum(positions.astype(int), n - 2)
+    weights = (positions - left).astype(values.dtype)
+
+    return values[..., left] * (1.0 - weights) + values[..., left + 1] * weights
+
+
+def interpolate_frames(values, timestamps, new_timestamps):
+    """
+    Linearly interpolates the frames (rows) of values in time, at new_timestamps. Frames outside the acquisition are
+    clamped to the first or last frame.
+    """
+    left = np.clip(np.searchsorted(timestamps, new_timestamps, side='right') - 1, 0, len(timestamps) - 2)
+    weights = np.clip((new_timestamps - timestamps[left]) / (timestamps[left + 1] - timestamps[left]), 0.0, 1.0).astype(values.dtype)
+
+    return values[left] * (1.0 - weights[:, None]) + values[left + 1] * weights[:, None]
 
 
 def write_image(path, values, delta_x, timestamps):
-    table = [['time'] + [delta_x * i for i in range(len(values[0]))]]
+    header = ['time'] + [delta_x * i for i in range(len(values[0]))]
+    rows = ([timestamp] + list(row) for timestamp, row in zip(timestamps, values))
+    write_values(path, itertools.chain([header], rows))
+
 
-    for timestamp, row in zip(timestamps, values):
-        table.append([timestamp] + row)
-    write_values(path, table)
+def remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 
 def write_values(path, values):
+    """
+    Writes a table (any iterable of rows) row by row, the file is never build in memory as a whole.
+    """
     with open(path, 'w') as f:
-        table = '\n'.join([','.join([str(value) for value in row]) for row in values])
-        f.write(table)
+        for i, row in enumerate(values):
+            if i:
+                f.write('\n')
+            f.write(','.join(map(str, row)))
+
+
+class Stopwatch:
+    """
+    Records the wall time between successive laps in a metrics dict (as '<stage>_time').
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.metrics[stage + '_time'] = now - self.last
+        self.last = now
+
+
+def analyze(delta_x, timestamps, values, stopwatch):
+    """
+    Fits a kymograph (delta_x in micro meter, the timestamps and values as arrays) and simulates it with the fitted
+    diffusion coefficient, in memory.
+    Returns a dict with the coefficient, its error and confidence interval, the high resolution steps and the arrays of
+    the cell by name (as in the binary bundle, see kymograph_arrays.py).
+    """
+    # factorizations depend on the diffusion coefficients of this cell only
+    factorize.cache_clear()
+    factorize_stack.cache_clear()
+    solver_counts.update(solver_calls=0, time_steps=0, max_substeps=0)
+
+    metrics = stopwatch.metrics
+    values = np.ascontiguousarray(values, dtype=dtype)
+    timestamps = np.asarray(timestamps, dtype=float)
+    metrics['frames'], metrics['pixels'] = values.shape
+
+    diffusion_coef, diffusion_coef_error = fit(values, delta_x, timestamps, solver, metrics)
+    stopwatch.lap('fit')
+
+    simulated = simulation(values[0], delta_x, timestamps, diffusion_coef, solver)
+    residuals = values - simulated
+    stopwatch.lap('simulation')
+
+    if uncertainty == 'bootstrap':
+        confidence_lower, confidence_upper = bootstrap(values, delta_x, timestamps, diffusion_coef, simulated, solver)
+    elif uncertainty == 'profile':
+        confidence_lower, confidence_upper = profile_likelihood(values, delta_x, timestamps, diffusion_coef, diffusion_coef_error, solver)
+    else:
+        confidence_lower = confidence_upper = ''
+
+    if confidence_lower != '' and not confidence_lower <= diffusion_coef <= confidence_upper:
+        print('warning: confidence interval [%g, %g] doesn\'t contain the fitted D %g' % (confidence_lower, confidence_upper, diffusion_coef))
+
+    stopwatch.lap('uncertainty')
+
+    arrays = {
+        'values': values,
+        'simulated': simulated,
+        'residuals': residuals,
+        'time': timestamps,
+        'distance': delta_x * np.arange(values.shape[1]),
+    }
+
+    high_res_delta_x = high_res_delta_t = ''
+
+    if high_resolution:
+        # create high resolution simulation, with a constant time step: the median delta t (discarding the first 5)
+        delta_ts = np.diff(timestamps)
+        delta_ts = np.sort(delta_ts[5:] if len(delta_ts) > 5 else delta_ts)
+        high_res_delta_t = delta_ts[len(delta_ts) // 2] / high_res_t_factor
+        high_res_delta_x = delta_x / high_res_x_factor
+
+        # enough steps to cover the whole acquisition
+        steps = int(math.ceil(round((timestamps[-1] - timestamps[0]) / high_res_delta_t, 6)))
+        high_res_timestamps = high_res_delta_t * np.arange(steps + 1)
+
+        high_res = batch_simulation(resample(values[0], high_res_x_factor), high_res_delta_x, high_res_timestamps, [diffusion_coef], solver)[0]
+
+        # upscaled residuals
+        high_res_values = resample(interpolate_frames(values, timestamps, high_res_timestamps), high_res_x_factor)
+
+        arrays.update({
+            'simulated-high-res': high_res,
+            'residuals-high-res': high_res_values - high_res,
+            'time-high-res': high_res_timestamps,
+            'distance-high-res': high_res_delta_x * np.arange(high_res.shape[1]),
+        })
+
+    metrics.update(solver_counts)
+    stopwatch.lap('high_res')
+
+    return {
+        'diffusion_coef': diffusion_coef,
+        'diffusion_coef_error': diffusion_coef_error,
+        'confidence_lower': confidence_lower,
+        'confidence_upper': confidence_upper,
+        'delta_x': delta_x,
+        'high_res_delta_x': high_res_delta_x,
+        'high_res_delta_t': high_res_delta_t,
+        'arrays': arrays,
+    }
+
+
+def write_results(base_path, result):
+    """
+    Saves the arrays of an analyzed cell to csv files and/or a binary bundle, depending on storage.
+    base_path is the path of the cell without suffix (e.g. 'data/1_cell'). Returns the row of the cell in
+    diffusion-coefficients.csv.
+    """
+    arrays = result['arrays']
+    delta_x, high_res_delta_x, high_res_delta_t = result['delta_x'], result['high_res_delta_x'], result['high_res_delta_t']
+
+    cell_id = re.split(r'\\', os.path.basename(base_path))[-1]
+    simulation_path = base_path + '-simulated.csv'
+    residuals_path = base_path + '-residuals.csv'
+    high_res_path = base_path + '-simulated-high-res.csv'
+    high_res_residuals_path = base_path + '-residuals-high-res.csv'
 
+    if storage in ('csv', 'both'):
+        write_image(simulation_path, arrays['simulated'], delta_x, arrays['time'])
+        write_image(residuals_path, arrays['residuals'], delta_x, arrays['time'])
 
-def flatten_list(l):
-    return [item for sublist in l for item in sublist]
+        if high_resolution:
+            write_image(high_res_path, arrays['simulated-high-res'], high_res_delta_x, arrays['time-high-res'])
+            write_image(high_res_residuals_path, arrays['residuals-high-res'], high_res_delta_x, arrays['time-high-res'])
 
+    # outputs of an earlier run with another storage would be read instead of the new ones (open_values, the report)
+    if storage == 'csv':
+        remove_bundle(base_path)
+    elif storage == 'binary':
+        remove_files(simulation_path, residuals_path, high_res_path, high_res_residuals_path)
 
-def to_matrix(l, w):
-    return [l[offset:offset + w] for offset in range(0, len(l), w)]
+    if storage in ('binary', 'both'):
+        arrays_path = write_bundle(base_path, **arrays)
 
+        if storage == 'binary':
+            simulation_path = residuals_path = high_res_path = arrays_path
 
-def process(path):
+    if not high_resolution:
+        high_res_path = ''
+
+        # the high resolution simulation of an earlier run was fitted with another D, the report would still draw it
+        remove_files(base_path + '-simulated-high-res.csv', high_res_residuals_path)
+        remove_bundle(base_path, ['simulated-high-res', 'residuals-high-res', 'time-high-res', 'distance-high-res'])
+
+    return result['diffusion_coef'], result['diffusion_coef_error'], simulation_path, residuals_path, high_res_path, high_res_delta_x, high_res_delta_t, cell_id, result['confidence_lower'], result['confidence_upper']
+
+
+def process(path, metrics=None):
     print('process %s' % path)
 
-    delta_x, timestamps, values = open_csv(path)
-    diffusion_coef, diffusion_coef_error = fit(values, delta_x, timestamps)
+    metrics = dict() if metrics is None else metrics
+    stopwatch = Stopwatch(metrics)
 
-    simulated = simulation(values[0], delta_x, timestamps, diffusion_coef)
-    residuals = determine_residuals(values, to_matrix(simulated, len(values[0])))
+    delta_x, timestamps, values = open_values(path)
+    stopwatch.lap('read')
 
-    # convert flattend list back to matrix
-    simulated = to_matrix(simulated, len(values[0]))
+    result = analyze(delta_x, timestamps, values, stopwatch)
 
-    # create high resolution simulation
-    high_res_values = list(grow(values[0]))
-    range_t = timestamps[-1] - timestamps[0]
+    if tolerance is not None:
+        print('%s: %d Crank-Nicolson steps, at most %d per frame interval' % (path, metrics['time_steps'], metrics['max_substeps']))
 
-    # take all delta t values
-    high_res_delta_ts = [t1 - t0 for t0, t1 in zip(timestamps[:-1], timestamps[1:])]
+    # save to csv files and/or a binary bundle
+    row = write_results(path[:-11], result)
+    stopwatch.lap('write')
 
-    # discard the first 5 values
-    high_res_delta_ts = high_res_delta_ts[5:]
-    # sort all delta_t's in ascending order
-    high_res_delta_ts = sorted(high_res_delta_ts)
-    # take the middle value (median)
-    high_res_delta_t = high_res_delta_ts[len(high_res_delta_ts) // 2]
+    return row
 
-    steps = int(math.ceil(range_t / high_res_delta_t))
-    high_res_timestamps = [i * high_res_delta_t for i in range(len(values))]
 
-    high_res_delta_x = delta_x / 2                              # we doubled the resolution (see grow function)
-    high_res = simulation(high_res_values, high_res_delta_x, high_res_timestamps, diffusion_coef)
+def find_cells(path):
+    """
+    Finds all kymographs (-values.csv files) in path and its subdirectories, in a deterministic order.
+    """
+    cells = list()
 
-    high_res = to_matrix(high_res, len(high_res_values))
+    for directory, directories, filenames in os.walk(path):
+        directories.sort()
+        cells.extend(os.path.join(directory, filename) for filename in sorted(filenames) if filename.endswith('-values.csv'))
 
-    # upscaled residuals
-    high_res_values = [list(grow(row)) for row in values]
-    high_res_residuals = determine_residuals(high_res_values, high_res)
+    return cells
 
 
- 
+def tree_cell_id(path, cell):
+    """
+    The id of a cell in the summary of the whole tree (summary = 'global'): the path of the cell relative to path,
+    e.g. 'day1/1_cell', as cells in different subdirectories can have the same name.
+    """
+    return os.path.relpath(cell[:-11], path).replace(os.sep, '/')
 
-    # save to csv files
-    base_path = path[:-11]
-    cell_id = re.split(r'\\', os.path.basename(base_path))[-1]
-    simulation_path = os.path.join(path, base_path + '-simulated.csv')
-    residuals_path = os.path.join(path, base_path + '-residuals.csv')
-    high_res_path = os.path.join(path, base_path + '-simulated-high-res.csv')
-    high_res_residuals_path = os.path.join(path, base_path + '-residuals-high-res.csv')
 
-    write_image(simulation_path, simulated, delta_x, timestamps)
-    write_image(residuals_path, residuals, delta_x, timestamps)
-    write_image(high_res_path, high_res, high_res_delta_x, high_res_timestamps)
-    write_image(high_res_residuals_path, high_res_residuals, high_res_delta_x, high_res_timestamps)
+def try_process(path):
+    """
+    Runs process and returns (result, None, metrics), or (None, traceback, metrics) when it fails so one cell can't
+    abort the batch.
+    """
+    cell_metrics = {'cell': path}
+    start = time.perf_counter()
 
-    return diffusion_coef, diffusion_coef_error, simulation_path, residuals_path, high_res_path, high_res_delta_x, high_res_delta_t, cell_id
+    try:
+        return process(path, cell_metrics), None, cell_metrics
+    except Exception:
+        return None, traceback.format_exc(), cell_metrics
+    finally:
+        cell_metrics['total_time'] = time.perf_counter() - start
 
 
-def process_all(path):
-    results = []
+def cell_hash(path):
+    """
+    Hash of the kymograph (of the file it is read from, see values_source) together with the fit settings, a cell with
+    an unchanged hash doesn't need to be fitted again.
+    """
+    sha = hashlib.sha1()
+
+    with open(values_source(path), 'rb') as f:
+        sha.update(f.read())
+
+    sha.update(repr((solver, tolerance, max_substeps, time_resolution, dtype, initial_diffusion_coef, fit_version, high_resolution, high_res_x_factor, high_res_t_factor, storage, uncertainty, confidence_level, bootstrap_samples)).encode())
+    return sha.hexdigest()
 
-    for filename in os.listdir(path):
-        full_path = os.path.join(path, filename)
 
-        if os.path.isdir(full_path):
-            process_all(full_path)
-        elif filename.endswith('-values.csv'):
-            results.append(process(full_path))
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, 'fit-manifest.json'), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return dict()
 
-    table = [['cell_id', 'diffusion_coefficient', 'diffusion_coefficient_error', 'simulation', 'residuals', 'high_res', 'high_res_delta_x', 'high_res_delta_t']]
-    for diffusion_coef, diffusion_coef_error, simulation_path, residuals_path, high_res_path, delta_x, delta_t, cell_id in results:
-            table.append([cell_id, '%g' % diffusion_coef, '%g' % diffusion_coef_error, simulation_path, residuals_path, high_res_path, str(delta_x), str(delta_t)])
+
+def write_manifest(path, manifest):
+    with open(os.path.join(path, 'fit-manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def process_cells(cells):
+    """
+    Processes cells in the process pool, returns a (result, error, metrics) tuple for each cell in the same order.
+    """
+    if workers > 1 and len(cells) > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            return list(executor.map(try_process, cells))
+    else:
+        return [try_process(cell) for cell in cells]
+
+
+def write_summary(path, results):
+    table = [['cell_id', 'diffusion_coefficient', 'diffusion_coefficient_error', 'simulation', 'residuals', 'high_res', 'high_res_delta_x', 'high_res_delta_t', 'diffusion_coefficient_lower', 'diffusion_coefficient_upper']]
+    for diffusion_coef, diffusion_coef_error, simulation_path, residuals_path, high_res_path, delta_x, delta_t, cell_id, lower, upper in results:
+            table.append([cell_id, '%g' % diffusion_coef, '%g' % diffusion_coef_error, simulation_path, residuals_path, high_res_path, str(delta_x), str(delta_t), lower and '%g' % lower, upper and '%g' % upper])
 
     output_path = os.path.join(path, 'diffusion-coefficients.csv')
     write_values(output_path, table)
 
 
-process_all(path)
+metric_columns = ['cell', 'status', 'frames', 'pixels', 'read_time', 'fit_time', 'simulation_time', 'uncertainty_time', 'high_res_time', 'write_time', 'total_time', 'function_evaluations', 'jacobian_evaluations', 'solver_calls', 'time_steps', 'max_substeps']
+
+
+def write_metrics(path, cell_metrics):
+    table = [metric_columns]
+    for m in cell_metrics:
+        table.append([m.get(column, '') for column in metric_columns])
+
+    write_values(os.path.join(path, 'fit-metrics.csv'), table)
+
+
+def print_metrics(cell_metrics):
+    """
+    Prints the total time spent in each stage and the slowest cells.
+    """
+    print('time per stage (s):')
+    for column in [column for column in metric_columns if column.endswith('_time')]:
+        print('  %-16s %10.3f' % (column[:-5], sum(m.get(column, 0) for m in cell_metrics)))
+
+    print('slowest cells:')
+    for m in sorted(cell_metrics, key=lambda m: m['total_time'], reverse=True)[:5]:
+        print('  %8.3f s  %5d frames  %4d pixels  %4d solver calls  %7d time steps  %s' % (m['total_time'], m.get('frames', 0), m.get('pixels', 0), m.get('solver_calls', 0), m.get('time_steps', 0), m['cell']))
+
+
+def process_all(path):
+    cells = find_cells(path)
+    hashes = [cell_hash(cell) for cell in cells]
+    manifests = {os.path.dirname(cell): read_manifest(os.path.dirname(cell)) for cell in cells}
+    outcomes = [None] * len(cells)
+
+    # reuse the results of cells that haven't changed (and of which the output still exists)
+    for i, (cell, digest) in enumerate(zip(cells, hashes)):
+        entry = manifests[os.path.dirname(cell)].get(os.path.basename(cell))
+
+        if incremental and entry and entry['hash'] == digest and all(os.path.exists(p) for p in entry['result'][2:5] if p):
+            outcomes[i] = tuple(entry['result']), None, None
+
+    stale = [i for i, outcome in enumerate(outcomes) if outcome is None]
+    print('%d cells up to date, %d cells to fit' % (len(cells) - len(stale), len(stale)))
+
+    for i, outcome in zip(stale, process_cells([cells[i] for i in stale])):
+        outcomes[i] = outcome
+        result, error, cell_metrics = outcome
+        cell_metrics['status'] = 'failed' if error else 'fitted'
+
+        if not error:
+            # the fit can write the bundle the next run reads the kymograph from, the hash covers that file
+            manifests[os.path.dirname(cells[i])][os.path.basename(cells[i])] = {'hash': cell_hash(cells[i]), 'result': list(result)}
+
+    for directory in set(os.path.dirname(cells[i]) for i in stale):
+        write_manifest(directory, manifests[directory])
+
+    # results per summary file, in the order the cells were found
+    results = {path: []}
+    all_metrics = {path: []}
+    failed = list()
+
+    for cell, (result, error, cell_metrics) in zip(cells, outcomes):
+        directory = path if summary == 'global' else os.path.dirname(cell)
+
+        if cell_metrics:
+            all_metrics.setdefault(directory, []).append(cell_metrics)
+
+        if error:
+            print('processing %s failed\n%s' % (cell, error))
+            failed.append(cell)
+            continue
+
+        if summary == 'global':
+            result = result[:7] + (tree_cell_id(path, cell),) + result[8:]
+
+        results.setdefault(directory, []).append(result)
+
+    for directory, directory_results in results.items():
+        write_summary(directory, directory_results)
+
+    if metrics:
+        for directory, directory_metrics in all_metrics.items():
+            write_metrics(directory, directory_metrics)
+
+        print_metrics([m for directory_metrics in all_metrics.values() for m in directory_metrics])
+
+    print('%d cells processed, %d failed' % (len(cells) - len(failed), len(failed)))
+    for cell in failed:
+        print('  %s' % cell)
+
+
+if __name__ == '__main__':
+    process_all(path)
@@ -2,6 +2,7 @@ import os
 import math
 
 from ij import IJ
+from ij.io import FileSaver
 from ij.plugin import ZProjector
 from ij.plugin import Zoom
 from ij.plugin.frame import RoiManager
@@ -15,6 +16,7 @@ from ij.plugin import ChannelSplitter
 
 path = 'G:\\My Drive\\EXPERIMENT DATA\\CONFOCAL LSM 710\\2021\\20210713\\M smegmatis mc2 155 pSMT3 dsRed\\FRAP16X16\\' 
 profile_width = 3
+page_size = 25	# number of images adjusted at a time, only the images of one page are kept in memory
 
 # globally sets the line width of ImageJ
 Line.setWidth(profile_width)
@@ -38,6 +40,40 @@ def open_image(path):
 		return imp
 
 
+def reference_path(path, photo_bleached_slice):
+	"""
+	The reference projection of an image is cached next to it, e.g. 'data/1_cell-reference-4.tif' for 'data/1_cell.lsm'
+	photo bleached at slice 4.
+	"""
+	return '%s-reference-%d.tif' % (os.path.splitext(path)[0], photo_bleached_slice)
+
+
+def read_reference(path, photo_bleached_slice):
+	"""
+	Returns the cached reference projection of an image, or None when there is no cache or the image changed since.
+	"""
+	cache_path = reference_path(path, photo_bleached_slice)
+	
+	if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+		return None
+	
+	return IJ.openImage(cache_path)
+
+
+def write_reference(path, photo_bleached_slice, reference_imp):
+	"""
+	Caches the reference projection of an image, the projections for other photo bleached slices are removed.
+	"""
+	directory, name = os.path.split(os.path.splitext(path)[0])
+	
+	for filename in os.listdir(directory or '.'):
+		if filename.startswith(name + '-reference-') and filename.endswith('.tif'):
+			os.remove(os.path.join(directory, filename))
+	
+	FileSaver(reference_imp).saveAsTiff(reference_path(path, photo_bleached_slice))
+
+
+
 def process(path):
 	
 	selections_path = os.path.join(path, 'selections.csv')
@@ -47,34 +83,47 @@ def process(path):
 		return
 
 	selections = read_selections(selections_path)
-	trimmed_selections = list()
-	
-	images = list()
+	available = list()
 	
-	for selection in selections:
+	for i, selection in enumerate(selections):
 		image_path = os.path.join(path, selection[0])
 
 		if not os.path.exists(image_path):
 			print('skipping %s, file doesn\'t exist' % (selection[0]))
 		else:		
-			images.append(read_image(image_path, selection[1]))
-			trimmed_selections.append(selection)
-			
-	offsets = create_grid(images)
-	set_selections(offsets, trimmed_selections)
+			available.append(i)
+	
+	pages = [available[i:i + page_size] for i in range(0, len(available), page_size)]
+	
+	for page_number, page in enumerate(pages):
+		# the images of a page are only read when the page is shown
+		trimmed_selections = [selections[i] for i in page]
+		images = [read_image(os.path.join(path, selection[0]), selection[1]) for selection in trimmed_selections]
+		
+		grid_imp, offsets = create_grid(images, 'selections %d of %d' % (page_number + 1, len(pages)))
+		images = None
+		set_selections(offsets, trimmed_selections)
 
-	zoom = Zoom()
-	for i in range(5):
-		zoom.run('in')
+		zoom = Zoom()
+		for i in range(5):
+			zoom.run('in')
 
-	dialog = WaitForUserDialog('Adjust selections and click OK when ready')
-	dialog.show()
+		dialog = WaitForUserDialog('Adjust selections (page %d of %d) and click OK when ready' % (page_number + 1, len(pages)))
+		dialog.show()
 
-	dialog = YesNoCancelDialog(None, 'Save selections', 'Do you want to save the selections?')
-	
-	if dialog.yesPressed():
-		adjusted_selections = get_adjusted_selections(trimmed_selections, offsets)
-		write_selections(os.path.join(path, 'selections.csv'), adjusted_selections)
+		dialog = YesNoCancelDialog(None, 'Save selections', 'Do you want to save the selections of this page?\n(Cancel stops adjusting.)')
+		
+		if dialog.yesPressed():
+			# selections.csv is written after every page, with the selections of the other pages unchanged
+			for i, adjusted_selection in zip(page, get_adjusted_selections(trimmed_selections, offsets)):
+				selections[i] = adjusted_selection
+			write_selections(selections_path, selections)
+		
+		grid_imp.changes = False
+		grid_imp.close()
+		
+		if dialog.cancelPressed():
+			break
 
 	
 
@@ -100,33 +149,33 @@ def read_selections(path):
 
 
 def read_image(path, photo_bleached_slice):
-	# open image
-	imp = open_image(path)
+	# the reference is usually cached by create_selections.py, then the image itself isn't opened
+	imp = read_reference(path, photo_bleached_slice)
 	
-	# create reference
-	z_projector = ZProjector(imp)
-	z_projector.setMethod(ZProjector.AVG_METHOD)
-	z_projector.setStopSlice(photo_bleached_slice - 1)
-	z_projector.doProjection()
-	imp = z_projector.getProjection()
+	if imp is None:
+		# open image
+		imp = open_image(path)
+		
+		# create reference
+		z_projector = ZProjector(imp)
+		z_projector.setMethod(ZProjector.AVG_METHOD)
+		z_projector.setStopSlice(photo_bleached_slice - 1)
+		z_projector.doProjection()
+		imp = z_projector.getProjection()
+		write_reference(path, photo_bleached_slice, imp)
 	
-	# normalize
+	# normalize, on the whole image at once
 	imp.deleteRoi()
-	IJ.run(imp, '32-bit', '')
-	statistics = imp.getStatistics()
-	ip = imp.getProcessor()
-
-	for y in range(ip.getHeight()):
-		for x in range(ip.getWidth()):
-			pixel = ip.getf(x, y)
-			pixel -= statistics.min
-			pixel /= (statistics.max - statistics.min)
-			ip.setf(x, y, pixel)
+	ip = imp.getProcessor().convertToFloat()
+	statistics = ip.getStats()
+	ip.subtract(statistics.min)
+	ip.multiply(1.0 / (statistics.max - statistics.min))
+	imp.setProcessor(ip)
 			
 	return imp
 
 
-def create_grid(images):
+def create_grid(images, title='selections'):
 	# determine number of columns
 	columns = int(math.ceil(math.sqrt(len(images))))
 	
@@ -137,7 +186,7 @@ def create_grid(images):
 
 	
 	# create grid and return (x,y) tuples of each image
-	grid_imp = IJ.createImage("selections", grid_width, grid_height, 1, 32)
+	grid_imp = IJ.createImage(title, grid_width, grid_height, 1, 32)
 	grid_ip = grid_imp.getProcessor()
 	
 	offsets = list()
@@ -149,14 +198,12 @@ def create_grid(images):
 		y0 = (i // columns) * image_height
 		offsets.append((x0, y0))
 		
-		for y in range(ip.getHeight()):
-			for x in range(ip.getWidth()):
-				pixel = ip.getf(x, y)
-				grid_ip.setf(x0 + x, y0 + y, pixel)
+		# copies the whole image into its block of the grid
+		grid_ip.insert(ip, x0, y0)
 
 	grid_imp.show()
 	
-	return offsets
+	return grid_imp, offsets
 
 
 def set_selections(offsets, selections):
@@ -1,11 +1,18 @@
 import os
+import json
 
-from loci.formats import ImageReader
+from loci.formats import ChannelSeparator
+from loci.formats import MetadataTools
+from loci.formats.in import DynamicMetadataOptions
+from loci.formats.in import MetadataLevel
+from loci.plugins.util import ImageProcessorReader
+from loci.plugins.util import LociPrefs
 from ij import IJ
+from ij import ImagePlus
+from ij import ImageStack
 from ij.gui import Line
-from java.util import Properties
-from java.lang import System
-from ij.plugin import ChannelSplitter
+from ij.io import FileSaver
+from ij.plugin import ZProjector
 
 
 path = 'G:\\My Drive\\EXPERIMENT DATA\\CONFOCAL LSM 710\\2021\\20210713\\M smegmatis mc2 155 pSMT3 dsRed\\FRAP16X16' 
@@ -16,40 +23,139 @@ profile_width = 3
 Line.setWidth(profile_width)
 
 
-def open_image(path):
+def sidecar_path(path):
 	"""
-	This function opens an image file. If it is an image stack we open the first channel that is not T PMT
+	The metadata of an image is cached next to it, e.g. 'data/1_cell-metadata.json' for 'data/1_cell.lsm'.
 	"""
-	imp = IJ.openImage(path)
-	
-	if imp.isHyperStack():
-		imps = ChannelSplitter.split(imp)
-		for imp in imps:
-			label = imp.getStack().getSliceLabel(1)
-			if label != 'T PMT':
-				return imp
-		return imps[0]
-	else:
-		return imp
-		
+	return os.path.splitext(path)[0] + '-metadata.json'
+
+
+def read_sidecar(path):
+	"""
+	Returns the cached metadata of an image, or None when there is no cache or the image changed since.
+	"""
+	try:
+		with open(sidecar_path(path)) as f:
+			metadata = json.load(f)
+	except (IOError, ValueError):
+		return None
+
+	if metadata.get('size') != os.path.getsize(path) or metadata.get('mtime') != os.path.getmtime(path):
+		return None
 
-def read_metadata(path):
-	reader = ImageReader()
-	reader.setId(path)
+	return metadata
+
+
+def write_sidecar(path, metadata):
+	metadata = dict(metadata, size=os.path.getsize(path), mtime=os.path.getmtime(path))
+
+	with open(sidecar_path(path), 'w') as f:
+		json.dump(metadata, f)
+
+
+def parse_metadata(reader, store):
+	"""
+	Reads the timestamps, the pixel size and the first channel that is not T PMT from an opened reader.
+	"""
 	channels = reader.getEffectiveSizeC()
 	count = reader.getImageCount() / channels
-	metadata = reader.getSeriesMetadata()
 	timestamps = [0] * count
+	pixel_size = 0
 	
-	for key, value in metadata.items():
+	for key, value in reader.getSeriesMetadata().items():
 		if key.startswith('TimeStamp'):
 			position = int(key[11:]) - 1
 			timestamps[position] = float(value)
 		elif key.startswith('VoxelSizeX'):
 			pixel_size = float(value)
 
+	channel = 0
+	for c in range(channels):
+		if store.getChannelName(0, c) != 'T PMT':
+			channel = c
+			break
 
-	return timestamps, pixel_size
+	return {'timestamps': timestamps, 'pixel_size': pixel_size, 'channel': channel}
+
+
+def load_image(path, first_slice=1):
+	"""
+	Opens an image file once and returns the image of the first channel that is not T PMT (only the planes of this
+	channel are read, from first_slice on), its timestamps and its pixel size. The metadata is cached in a sidecar file
+	shared by the scripts, when the sidecar is up to date the file is opened without parsing the full metadata.
+	"""
+	metadata = read_sidecar(path)
+	reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
+	
+	if metadata:
+		reader.setMetadataOptions(DynamicMetadataOptions(MetadataLevel.MINIMUM))
+	else:
+		store = MetadataTools.createOMEXMLMetadata()
+		reader.setMetadataStore(store)
+	
+	try:
+		reader.setId(path)
+		
+		if not metadata:
+			metadata = parse_metadata(reader, store)
+			write_sidecar(path, metadata)
+		
+		stack = ImageStack(reader.getSizeX(), reader.getSizeY())
+		slice_number = 0
+		for i in range(reader.getImageCount()):
+			if reader.getZCTCoords(i)[1] == metadata['channel']:
+				slice_number += 1
+				if slice_number >= first_slice:
+					stack.addSlice(reader.openProcessors(i)[0])
+	finally:
+		reader.close()
+	
+	return ImagePlus(os.path.basename(path), stack), metadata['timestamps'], metadata['pixel_size']
+
+
+def reference_path(path, photo_bleached_slice):
+	"""
+	The reference projection of an image is cached next to it, e.g. 'data/1_cell-reference-4.tif' for 'data/1_cell.lsm'
+	photo bleached at slice 4.
+	"""
+	return '%s-reference-%d.tif' % (os.path.splitext(path)[0], photo_bleached_slice)
+
+
+def read_reference(path, photo_bleached_slice):
+	"""
+	Returns the cached reference projection of an image, or None when there is no cache or the image changed since.
+	"""
+	cache_path = reference_path(path, photo_bleached_slice)
+	
+	if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+		return None
+	
+	return IJ.openImage(cache_path)
+
+
+def write_reference(path, photo_bleached_slice, reference_imp):
+	"""
+	Caches the reference projection of an image, the projections for other photo bleached slices are removed.
+	"""
+	directory, name = os.path.split(os.path.splitext(path)[0])
+	
+	for filename in os.listdir(directory or '.'):
+		if filename.startswith(name + '-reference-') and filename.endswith('.tif'):
+			os.remove(os.path.join(directory, filename))
+	
+	FileSaver(reference_imp).saveAsTiff(reference_path(path, photo_bleached_slice))
+
+
+
+def create_reference(imp, photo_bleached_slice):
+	"""
+	Averages all frames before photo bleaching.
+	"""
+	z_projector = ZProjector(imp)
+	z_projector.setMethod(ZProjector.AVG_METHOD)
+	z_projector.setStopSlice(photo_bleached_slice - 1)
+	z_projector.doProjection()
+	return z_projector.getProjection()
 
 
 def read_selections(path):
@@ -86,24 +192,24 @@ def get_profiles(path, selection):
 		print('image \'%s\' does not exist, image will be skipped.')
 		return
 
-	imp = open_image(image_path)
+	# with a cached reference projection the frames before photo bleaching aren't read
+	reference_imp = read_reference(image_path, photo_bleached)
+	first_slice = 1 if reference_imp is None else photo_bleached
+
+	# pixels and metadata are read in a single pass
+	imp, timestamps, pixel_size = load_image(image_path, first_slice)
+	
+	if reference_imp is None:
+		reference_imp = create_reference(imp, photo_bleached)
+		write_reference(image_path, photo_bleached, reference_imp)
+	
 	n = imp.getImageStackSize();
-	reference = list()
 	profiles = list()
 	line = Line(x1, y1, x2, y2)
 	
-	for i in range(1, photo_bleached):
-		imp.setSlice(i)
-		imp.setRoi(line)
-		profile = line.getPixels()
-		
-		if not reference:
-			reference = profile
-		else:
-			reference = [a + b for a, b in zip(reference, profile)]
-
-	# average profile of all slice before photo bleaching
-	reference = [float(a) / (photo_bleached - 1) for a in reference]
+	# average profile of all slice before photo bleaching, the profile of the average projection
+	reference_imp.setRoi(line)
+	reference = list(line.getPixels())
 	
 	# and subtract backgound
 	reference = [a - background for a in reference]
@@ -111,29 +217,21 @@ def get_profiles(path, selection):
 	# determine the integrated value (sum) of reference
 	reference_integrated = sum(reference)
 	
-	for i in range(photo_bleached, n + 1):
+	# the part of the normalization that is the same for every frame
+	factors = [reference_integrated / a for a in reference]
+	
+	for i in range(photo_bleached - first_slice + 1, n + 1):
 		imp.setSlice(i)
 		imp.setRoi(line)
 
 		profile = line.getPixels()
 		
-		# subtract background
-		profile = [a - background for a in profile]
-
-		# determine integrated value
-		profile_integrated = sum(profile)
-
-		# divide by integrated profile
-		# multiply with integrated reference
-		# divide by reference profile
-		profile = [a / profile_integrated for a in profile]
-		profile = [a * reference_integrated for a in profile]
-		profile = [a / b for a, b in zip(profile, reference)]
-		
-		profiles.append(profile)
+		# determine integrated value (after background subtraction)
+		profile_integrated = sum(profile) - background * len(profile)
 
-	# read timestamps and pixel size
-	timestamps, pixel_size = read_metadata(image_path)
+		# subtract background, divide by integrated profile, multiply with integrated reference and divide by
+		# reference profile in one pass
+		profiles.append([(a - background) * factor / profile_integrated for a, factor in zip(profile, factors)])
 
 	# remove all the time stamps before photo bleaching and make sure they start from 0
 	timestamps = timestamps[photo_bleached:]
@@ -143,13 +241,16 @@ def get_profiles(path, selection):
 
 
 def write_kymograph(path, profiles, timestamps, pixel_size):
+	"""
+	Writes the kymograph row by row, every row is formatted at once with a preformatted row format.
+	"""
+	columns = len(profiles[0])
+	row_format = ','.join(['%f'] * (columns + 1)) + '\n'
+	
 	with open(path, 'w') as f:
-		distance = ['%f' % (i * pixel_size) for i in range(len(profiles[0]))]
-		str = 'time,' + ','.join(distance) + '\n'
+		f.write('time,' + ','.join(['%f' % (i * pixel_size) for i in range(columns)]) + '\n')
 		for timestamp, profile in zip(timestamps, profiles):
-			str += '%f,' % (timestamp)
-			str += ','.join(['%f' % value for value in profile]) + '\n'
-		f.write(str)
+			f.write(row_format % tuple([timestamp] + list(profile)))
 	
 	
 def process(path):
@@ -1,14 +1,32 @@
 import os
+import math
+import json
 
+from loci.formats import ChannelSeparator
+from loci.formats import MetadataTools
+from loci.formats.in import DynamicMetadataOptions
+from loci.formats.in import MetadataLevel
+from loci.plugins.util import ImageProcessorReader
+from loci.plugins.util import LociPrefs
 from ij import IJ
+from ij import ImagePlus
+from ij import ImageStack
+from ij.io import FileSaver
+from ij.measure import Measurements
 from ij.plugin import ZProjector
-from ij.plugin import ChannelSplitter
+from ij.plugin.filter import ThresholdToSelection
+from ij.process import ImageStatistics
+from java.lang import Exception as JavaException
+from java.lang import Runtime
+from java.util.concurrent import Callable
+from java.util.concurrent import Executors
 
 
 
 path = 'G:\\My Drive\\EXPERIMENT DATA\\CONFOCAL LSM 710\\2021\\20210713\\M smegmatis mc2 155 pSMT3 dsRed\\FRAP16X16\\' 
 bg_selection_width = 5	# for background detection a rectangular selection of this width (and height) is used
 selection_line_fraction = 0.8	# change this value to extend or shorten the found selections
+workers = Runtime.getRuntime().availableProcessors()	# number of files processed at the same time, 1 processes them one by one
 
 
 def find_photo_bleached_slice(imp):
@@ -34,15 +52,55 @@ def find_photo_bleached_slice(imp):
 	return -1
 
 
-def create_reference(imp, photo_bleached_slice):
+def reference_path(path, photo_bleached_slice):
 	"""
-	Averages all frames before photo bleaching.
+	The reference projection of an image is cached next to it, e.g. 'data/1_cell-reference-4.tif' for 'data/1_cell.lsm'
+	photo bleached at slice 4.
 	"""
-	z_projector = ZProjector(imp)
-	z_projector.setMethod(ZProjector.AVG_METHOD)
-	z_projector.setStopSlice(photo_bleached_slice - 1)
-	z_projector.doProjection()
-	return z_projector.getProjection()
+	return '%s-reference-%d.tif' % (os.path.splitext(path)[0], photo_bleached_slice)
+
+
+def read_reference(path, photo_bleached_slice):
+	"""
+	Returns the cached reference projection of an image, or None when there is no cache or the image changed since.
+	"""
+	cache_path = reference_path(path, photo_bleached_slice)
+	
+	if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+		return None
+	
+	return IJ.openImage(cache_path)
+
+
+def write_reference(path, photo_bleached_slice, reference_imp):
+	"""
+	Caches the reference projection of an image, the projections for other photo bleached slices are removed.
+	"""
+	directory, name = os.path.split(os.path.splitext(path)[0])
+	
+	for filename in os.listdir(directory or '.'):
+		if filename.startswith(name + '-reference-') and filename.endswith('.tif'):
+			os.remove(os.path.join(directory, filename))
+	
+	FileSaver(reference_imp).saveAsTiff(reference_path(path, photo_bleached_slice))
+
+
+def create_reference(imp, photo_bleached_slice, path):
+	"""
+	Averages all frames before photo bleaching. The projection is cached per image and photo bleached slice, so
+	adjust_selections.py and create_kymographs_fixed.py don't have to read the frames before photo bleaching again.
+	"""
+	reference_imp = read_reference(path, photo_bleached_slice)
+	
+	if reference_imp is None:
+		z_projector = ZProjector(imp)
+		z_projector.setMethod(ZProjector.AVG_METHOD)
+		z_projector.setStopSlice(photo_bleached_slice - 1)
+		z_projector.doProjection()
+		reference_imp = z_projector.getProjection()
+		write_reference(path, photo_bleached_slice, reference_imp)
+	
+	return reference_imp
 
 
 def measure_background(imp):
@@ -64,35 +122,109 @@ def measure_background(imp):
 def find_selection(imp):
 	"""
 	Finds the selection through the cell by fitting an ellipse to the thresholded image.
+	Works on a copy of the processor only (like Convert to Mask, Create Selection and Fit Ellipse, but without the
+	current image and ROI of ImageJ), so images can be processed at the same time.
 	"""
 	
-	imp.deleteRoi()
-	imp = imp.duplicate()
-	IJ.setAutoThreshold(imp, 'Default dark')
-	IJ.run(imp, 'Convert to Mask', '')
-	IJ.run(imp, 'Create Selection', '')
-	IJ.run(imp, 'Fit Ellipse', '')
-	ellipse = imp.getRoi()
-	return ellipse.getParams()
+	ip = imp.getProcessor().duplicate()
+	ip.resetRoi()
+	ip.setAutoThreshold('Default dark')
+	roi = ThresholdToSelection().convert(ip)
+	
+	ip.setRoi(roi)
+	statistics = ImageStatistics.getStatistics(ip, Measurements.CENTROID + Measurements.ELLIPSE, None)
+	dx = statistics.major * math.cos(math.radians(statistics.angle)) / 2
+	dy = -statistics.major * math.sin(math.radians(statistics.angle)) / 2
+	
+	return statistics.xCentroid - dx, statistics.yCentroid - dy, statistics.xCentroid + dx, statistics.yCentroid + dy, statistics.minor / statistics.major
+
 
 
+def sidecar_path(path):
+	"""
+	The metadata of an image is cached next to it, e.g. 'data/1_cell-metadata.json' for 'data/1_cell.lsm'.
+	"""
+	return os.path.splitext(path)[0] + '-metadata.json'
 
-def open_image(path):
+
+def read_sidecar(path):
 	"""
-	This function opens an image file. If it is an image stack we open the first channel that is not T PMT
+	Returns the cached metadata of an image, or None when there is no cache or the image changed since.
 	"""
-	imp = IJ.openImage(path)
-	imp.getTitle()
+	try:
+		with open(sidecar_path(path)) as f:
+			metadata = json.load(f)
+	except (IOError, ValueError):
+		return None
+
+	if metadata.get('size') != os.path.getsize(path) or metadata.get('mtime') != os.path.getmtime(path):
+		return None
+
+	return metadata
+
+
+def write_sidecar(path, metadata):
+	metadata = dict(metadata, size=os.path.getsize(path), mtime=os.path.getmtime(path))
+
+	with open(sidecar_path(path), 'w') as f:
+		json.dump(metadata, f)
+
+
+def parse_metadata(reader, store):
+	"""
+	Reads the timestamps, the pixel size and the first channel that is not T PMT from an opened reader.
+	"""
+	channels = reader.getEffectiveSizeC()
+	count = reader.getImageCount() / channels
+	timestamps = [0] * count
+	pixel_size = 0
+	
+	for key, value in reader.getSeriesMetadata().items():
+		if key.startswith('TimeStamp'):
+			position = int(key[11:]) - 1
+			timestamps[position] = float(value)
+		elif key.startswith('VoxelSizeX'):
+			pixel_size = float(value)
+
+	channel = 0
+	for c in range(channels):
+		if store.getChannelName(0, c) != 'T PMT':
+			channel = c
+			break
+
+	return {'timestamps': timestamps, 'pixel_size': pixel_size, 'channel': channel}
+
+
+def load_image(path):
+	"""
+	Opens an image file once and returns the image of the first channel that is not T PMT (only the planes of this
+	channel are read), its timestamps and its pixel size. The metadata is cached in a sidecar file shared by the
+	scripts, when the sidecar is up to date the file is opened without parsing the full metadata.
+	"""
+	metadata = read_sidecar(path)
+	reader = ImageProcessorReader(ChannelSeparator(LociPrefs.makeImageReader()))
 	
-	if imp.isHyperStack():
-		imps = ChannelSplitter.split(imp)
-		for imp in imps:
-			label = imp.getStack().getSliceLabel(1)
-			if label != 'T PMT':
-				return imp
-		return imps[0]
+	if metadata:
+		reader.setMetadataOptions(DynamicMetadataOptions(MetadataLevel.MINIMUM))
 	else:
-		return imp
+		store = MetadataTools.createOMEXMLMetadata()
+		reader.setMetadataStore(store)
+	
+	try:
+		reader.setId(path)
+		
+		if not metadata:
+			metadata = parse_metadata(reader, store)
+			write_sidecar(path, metadata)
+		
+		stack = ImageStack(reader.getSizeX(), reader.getSizeY())
+		for i in range(reader.getImageCount()):
+			if reader.getZCTCoords(i)[1] == metadata['channel']:
+				stack.addSlice(reader.openProcessors(i)[0])
+	finally:
+		reader.close()
+	
+	return ImagePlus(os.path.basename(path), stack), metadata['timestamps'], metadata['pixel_size']
 
 			
 def process(path):
@@ -102,15 +234,15 @@ def process(path):
 
 	print('processing %s' % filename)
 	
-	imp = open_image(path)
+	# also caches the metadata for create_kymographs_fixed.py
+	imp, timestamps, pixel_size = load_image(path)
 	
 	photo_bleached_slice = find_photo_bleached_slice(imp)
 	
 	if photo_bleached_slice == -1:
-		print('could not detect photo bleached slice')
-		return
+		raise ValueError('could not detect photo bleached slice')
 	
-	reference_imp = create_reference(imp, photo_bleached_slice)
+	reference_imp = create_reference(imp, photo_bleached_slice, path)
 	background = measure_background(reference_imp)
 	x1, y1, x2, y2, aspectRatio = find_selection(reference_imp)
 
@@ -127,12 +259,40 @@ def process(path):
 	return filename, photo_bleached_slice, background, x1, y1, x2, y2, aspectRatio
 
 
+class ProcessTask(Callable):
+	"""
+	Processes one file on a thread of the pool, returns (selection, None) or (None, error).
+	"""
+	
+	def __init__(self, path):
+		self.path = path
+	
+	def call(self):
+		try:
+			return process(self.path), None
+		except (Exception, JavaException) as e:
+			print('%s failed: %s' % (os.path.basename(self.path), e))
+			return None, str(e)
+
+
 def process_all(path):
-	cells = list()
+	global workers
+	
+	filenames = sorted(filename for filename in os.listdir(path) if filename.endswith('.lsm'))
+	tasks = [ProcessTask(os.path.join(path, filename)) for filename in filenames]
+	
+	if workers > 1 and len(tasks) > 1:
+		executor = Executors.newFixedThreadPool(min(workers, len(tasks)))
+		try:
+			# futures are collected in the order of the filenames
+			results = [future.get() for future in executor.invokeAll(tasks)]
+		finally:
+			executor.shutdown()
+	else:
+		results = [task.call() for task in tasks]
 
-	for filename in os.listdir(path):
-		if filename.endswith('.lsm'):
-			cells.append(process(os.path.join(path, filename)))
+	cells = [cell for cell, error in results if cell is not None]
+	failures = [(filename, error) for filename, (cell, error) in zip(filenames, results) if cell is None]
 
 	selections_path = os.path.join(path, 'selections.csv')
 	with open(selections_path, 'w') as f:
@@ -141,5 +301,17 @@ def process_all(path):
 			f.write('%20s, %10d, %10.3f, %10.3f, %10.3f, %10.3f, %10.3f, %10.3f\n' % cell)
 
 	print(selections_path)
+	
+	# files without a selection are listed separately, so selections.csv can still be read by the other scripts
+	failures_path = os.path.join(path, 'selections-failed.csv')
+	if failures:
+		with open(failures_path, 'w') as f:
+			f.write('%20s, %s\n' % ('filename', 'error'))
+			for failure in failures:
+				f.write('%20s, %s\n' % failure)
+		
+		print('%d of %d files failed, see %s' % (len(failures), len(filenames), failures_path))
+	elif os.path.exists(failures_path):
+		os.remove(failures_path)
 
 process_all(path)
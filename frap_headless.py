@@ -0,0 +1,288 @@
+"""
+The automatic steps of create_selections.py (photo bleach detection, background estimation and selection detection)
+and of create_kymographs_fixed.py (kymograph extraction) on NumPy arrays, for stacks opened with lsm_stack.py.
+Run it to create the kymographs (-values.csv) of all selections in selections.csv without Fiji.
+"""
+
+import os
+import math
+
+import numpy as np
+import tifffile
+from scipy import sparse
+
+from lsm_stack import open_image
+
+path = os.getcwd()
+bg_selection_width = 5      # for background detection a rectangular selection of this width (and height) is used
+selection_line_fraction = 0.8   # change this value to extend or shorten the found selections
+profile_width = 3           # width of the selection line (in pixels) the profiles are averaged over
+
+
+def find_photo_bleached_slice(frames):
+    """
+    This functions tries to find the first photo bleached frame.
+    When the mean intensity of the frame drops below 80% of the mean intensity of the first frame
+    it is considered photo bleached. Only the first 10 frames are considered.
+    Returns the (1 based) slice number of the frame that is photo bleached or -1 if no such frame is found.
+    """
+    means = frames[:10].mean(axis=(1, 2))
+    bleached = np.flatnonzero(means[1:] < means[0] * 0.8)
+
+    return int(bleached[0]) + 2 if len(bleached) else -1
+
+
+def create_reference(frames, photo_bleached_slice):
+    """
+    Averages all frames before photo bleaching.
+    """
+    return frames[:photo_bleached_slice - 1].mean(axis=0)
+
+
+def reference_path(path, photo_bleached_slice):
+    """
+    The reference projection of an image is cached next to it, e.g. 'data/1_cell-reference-4.tif' for 'data/1_cell.lsm'
+    photo bleached at slice 4 (shared with the Fiji scripts).
+    """
+    return '%s-reference-%d.tif' % (os.path.splitext(path)[0], photo_bleached_slice)
+
+
+def read_reference(path, photo_bleached_slice):
+    """
+    Returns the cached reference projection of an image, or None when there is no cache or the image changed since.
+    """
+    cache_path = reference_path(path, photo_bleached_slice)
+
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+        return None
+
+    return tifffile.imread(cache_path).astype(float)
+
+
+def write_reference(path, photo_bleached_slice, reference):
+    """
+    Caches the reference projection of an image (32 bit, as ImageJ), the projections for other photo bleached slices
+    are removed.
+    """
+    directory, name = os.path.split(os.path.splitext(path)[0])
+
+    for filename in os.listdir(directory or '.'):
+        if filename.startswith(name + '-reference-') and filename.endswith('.tif'):
+            os.remove(os.path.join(directory, filename))
+
+    tifffile.imwrite(reference_path(path, photo_bleached_slice), reference.astype(np.float32), imagej=True)
+
+
+def measure_background(reference, width=bg_selection_width):
+    """
+    Measures the background value by taking the corner with the lowest mean pixel intensity.
+    """
+    return float(min(reference[:width, :width].mean(), reference[:width, -width:].mean(),
+                     reference[-width:, :width].mean(), reference[-width:, -width:].mean()))
+
+
+def default_threshold(image):
+    """
+    ImageJ's 'Default' auto threshold (a variant of IsoData) on a 256 bin histogram of the image.
+    Returns the lowest value of the foreground (the bright pixels).
+    """
+    histogram, edges = np.histogram(image, bins=256, range=(float(image.min()), float(image.max())))
+    histogram = histogram.astype(float)
+
+    # like ImageJ, the lowest and highest bins are ignored
+    histogram[0] = histogram[-1] = 0
+    filled = np.flatnonzero(histogram)
+    if len(filled) < 2:
+        return edges[len(histogram) // 2]
+
+    minimum, maximum = filled[0], filled[-1]
+    histogram = histogram[:maximum + 1]
+    bins = np.arange(maximum + 1)
+
+    # the iteration of ImageJ for every moving index at once: the threshold is the average of the means below and above
+    moving = np.arange(minimum, maximum)
+    below_count = np.cumsum(histogram)[moving]
+    below_sum = np.cumsum(histogram * bins)[moving]
+    results = (below_sum / below_count + (below_sum[-1] + maximum * histogram[maximum] - below_sum) / (below_count[-1] + histogram[maximum] - below_count)) / 2
+    stop = np.argmax((moving + 2 > results) | (moving + 1 >= maximum - 1))
+
+    return edges[int(round(results[stop])) + 1]
+
+
+def fit_ellipse(mask):
+    """
+    Fits an ellipse to the pixels of a mask with the same second moments (like Fit Ellipse in ImageJ).
+    Returns the end points of the major axis and the aspect ratio (x1, y1, x2, y2, aspect ratio) in ImageJ coordinates.
+    """
+    y, x = np.nonzero(mask)
+    x = x + 0.5
+    y = y + 0.5
+    x_center, y_center = x.mean(), y.mean()
+
+    # central moments of the pixels, every pixel being a square
+    xx = ((x - x_center) ** 2).mean() + 1 / 12
+    yy = ((y - y_center) ** 2).mean() + 1 / 12
+    xy = ((x - x_center) * (y - y_center)).mean()
+
+    root = math.sqrt(((xx - yy) / 2) ** 2 + xy ** 2)
+    major = 4 * math.sqrt((xx + yy) / 2 + root)
+    minor = 4 * math.sqrt(max((xx + yy) / 2 - root, 0))
+
+    # scale, so the area of the ellipse is the area of the mask
+    scale = math.sqrt(len(x) / (math.pi * major * minor / 4)) if minor > 0 else 1
+    major, minor = major * scale, minor * scale
+
+    # ImageJ measures the angle counterclockwise, with y pointing down in the image
+    angle = -0.5 * math.atan2(2 * xy, xx - yy) % math.pi
+    dx = major * math.cos(angle) / 2
+    dy = -major * math.sin(angle) / 2
+
+    return x_center - dx, y_center - dy, x_center + dx, y_center + dy, minor / major
+
+
+def find_selection(reference):
+    """
+    Finds the selection through the cell by fitting an ellipse to the thresholded image, shortened (or extended) to
+    selection_line_fraction of its major axis.
+    """
+    x1, y1, x2, y2, aspect_ratio = fit_ellipse(reference >= default_threshold(reference))
+
+    x0 = (x1 + x2) / 2
+    y0 = (y1 + y2) / 2
+    dx = ((x2 - x1) / 2) * selection_line_fraction
+    dy = ((y2 - y1) / 2) * selection_line_fraction
+
+    return x0 - dx, y0 - dy, x0 + dx, y0 + dy, aspect_ratio
+
+
+def line_operator(shape, x1, y1, x2, y2, width=profile_width):
+    """
+    The sampling of the line from (x1, y1) to (x2, y2) in an image of shape (height, width) as a sparse
+    (points x pixels) matrix, over the pixels the line touches only. Like a wide line in ImageJ, every point is the
+    average of width points perpendicular to the line, one pixel apart, with bilinear interpolation.
+    Returns the matrix and the (flat) indices of its pixels in the image.
+    """
+    dx, dy = x2 - x1, y2 - y1
+    length = math.hypot(dx, dy)
+    n = int(round(length))
+
+    along = np.arange(n)[:, None]
+    across = np.arange(width)[None, :] - (width - 1) / 2
+    x = x1 + along * dx / n - across * dy / length
+    y = y1 + along * dy / n + across * dx / length
+
+    height, image_width = shape
+    x0 = np.clip(np.floor(x).astype(int), 0, image_width - 2)
+    y0 = np.clip(np.floor(y).astype(int), 0, height - 2)
+    fx = x - x0
+    fy = y - y0
+
+    # the four neighbouring pixels of every sample and their weights, duplicates are summed by the matrix
+    indices = np.stack([y0 * image_width + x0, y0 * image_width + x0 + 1, (y0 + 1) * image_width + x0, (y0 + 1) * image_width + x0 + 1])
+    weights = np.stack([(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy]) / width
+    rows = np.broadcast_to(np.arange(n)[:, None], x.shape)
+
+    pixels, columns = np.unique(indices, return_inverse=True)
+    matrix = sparse.csr_matrix((weights.ravel(), (np.broadcast_to(rows, indices.shape).ravel(), columns.ravel())), shape=(n, len(pixels)))
+
+    return matrix, pixels
+
+
+def line_profiles(frames, x1, y1, x2, y2, width=profile_width):
+    """
+    Returns the profiles (frames x points) along the line from (x1, y1) to (x2, y2) of all frames at once: only the
+    pixels under the line are read and sampled with one product of the line operator (see line_operator).
+    """
+    matrix, pixels = line_operator(frames.shape[1:], x1, y1, x2, y2, width)
+    samples = frames.reshape(len(frames), -1)[:, pixels]
+
+    return np.asarray((matrix @ samples.T.astype(float)).T)
+
+
+def get_profiles(frames, selection, reference=None):
+    """
+    Returns the normalized profiles of all frames from the photo bleached frame on. Every profile is divided by its
+    integrated value, multiplied with the integrated reference (the average profile before photo bleaching) and
+    divided by the reference profile, all after background subtraction.
+    With the reference projection (see create_reference) the frames before photo bleaching aren't read.
+    """
+    filename, photo_bleached, background, x1, y1, x2, y2, aspect_ratio = selection
+
+    if reference is None:
+        profiles = line_profiles(frames, x1, y1, x2, y2) - background
+        reference = profiles[:photo_bleached - 1].mean(axis=0)
+        profiles = profiles[photo_bleached - 1:]
+    else:
+        reference = line_profiles(reference[None], x1, y1, x2, y2)[0] - background
+        profiles = line_profiles(frames[photo_bleached - 1:], x1, y1, x2, y2) - background
+
+    return profiles / profiles.sum(axis=1, keepdims=True) * reference.sum() / reference
+
+
+def read_selections(path):
+    selections = list()
+
+    with open(path) as f:
+        lines = f.readlines()
+        columns = [column.strip() for column in lines[0].split(',')]
+
+        for line in lines[1:]:
+            try:
+                values = dict(zip(columns, [value.strip() for value in line.split(',')]))
+                selections.append((
+                    values['filename'],
+                    int(values['photo_bleached']),
+                    float(values['background']),
+                    float(values['x1']),
+                    float(values['y1']),
+                    float(values['x2']),
+                    float(values['y2']),
+                    float(values['aspect_ratio'])
+                ))
+            except (KeyError, ValueError):
+                pass
+
+    return selections
+
+
+def write_kymograph(path, profiles, timestamps, pixel_size):
+    """
+    Writes the kymograph in the format of create_kymographs_fixed.py.
+    """
+    columns = profiles.shape[1]
+    row_format = ','.join(['%f'] * (columns + 1)) + '\n'
+
+    with open(path, 'w') as f:
+        f.write('time,' + ','.join(['%f' % (i * pixel_size) for i in range(columns)]) + '\n')
+        for timestamp, profile in zip(timestamps, profiles):
+            f.write(row_format % (timestamp, *profile))
+
+
+def process(path):
+    selections_path = os.path.join(path, 'selections.csv')
+
+    if not os.path.exists(selections_path):
+        print('selections.csv could not be found in \'%s\'. (re-)run create_selections.py' % path)
+        return
+
+    for selection in read_selections(selections_path):
+        filename, photo_bleached = selection[:2]
+        image_path = os.path.join(path, filename)
+
+        if not os.path.exists(image_path):
+            print('image \'%s\' does not exist, image will be skipped.' % filename)
+            continue
+
+        print('processing %s' % filename)
+        frames, timestamps, pixel_size = open_image(image_path)
+        profiles = get_profiles(frames, selection, read_reference(image_path, photo_bleached))
+
+        # remove all the time stamps before photo bleaching and make sure they start from 0 (as create_kymographs_fixed.py)
+        timestamps = np.asarray(timestamps[photo_bleached:])
+        timestamps -= timestamps[0]
+
+        write_kymograph(os.path.join(path, filename[:-4] + '-values.csv'), profiles, timestamps, pixel_size)
+
+
+if __name__ == '__main__':
+    process(path)
@@ -0,0 +1,159 @@
+"""
+Streams every .lsm file of a directory through the whole analysis in memory: photo bleach and selection detection and
+kymograph extraction (frap_headless.py), fitting (1d_heat_diff_fit.py) and optionally the report of the cell
+(plotting_arrays_002.py, run it afterwards for allcells.pdf).
+Files are loaded on a separate thread, at most queue_size cells ahead of the fitting, so reading the next files overlaps
+with fitting the current one. Only diffusion-coefficients.csv is written, unless persist is set.
+"""
+
+import os
+import queue
+import threading
+import importlib
+import traceback
+
+import numpy as np
+
+import frap_headless
+from lsm_stack import open_image
+
+heat_diffusion_fit = importlib.import_module('1d_heat_diff_fit')
+
+path = os.getcwd()
+queue_size = 4          # number of loaded cells waiting to be fitted, limits the memory used when loading is faster
+persist = False         # also write selections.csv, the kymographs and the simulations (see storage in 1d_heat_diff_fit.py)
+render = False          # also render the report of every cell (<cell>-graphs.png), needs persist
+
+
+def load_cell(path, filename, selections):
+    """
+    Loads an .lsm file and extracts its kymograph. The selection of the file in selections.csv is used when there is
+    one (e.g. adjusted with adjust_selections.py), otherwise it is detected.
+    Returns the selection, the pixel size (µm), the timestamps (s) and the kymograph (timestamps x points).
+    """
+    image_path = os.path.join(path, filename)
+    frames, timestamps, pixel_size = open_image(image_path)
+    selection = selections.get(filename)
+
+    if selection is None:
+        photo_bleached_slice = frap_headless.find_photo_bleached_slice(frames)
+
+        if photo_bleached_slice == -1:
+            raise ValueError('could not detect photo bleached slice')
+
+        reference = frap_headless.create_reference(frames, photo_bleached_slice)
+        background = frap_headless.measure_background(reference)
+        selection = (filename, photo_bleached_slice, background) + frap_headless.find_selection(reference)
+
+        if persist:
+            frap_headless.write_reference(image_path, photo_bleached_slice, reference)
+    else:
+        # the reference projection cached by an earlier run or the Fiji scripts, if any
+        reference = frap_headless.read_reference(image_path, selection[1])
+
+    photo_bleached = selection[1]
+    values = frap_headless.get_profiles(frames, selection, reference)
+
+    # remove all the time stamps before photo bleaching and make sure they start from 0 (as create_kymographs_fixed.py)
+    timestamps = np.asarray(timestamps[photo_bleached:])
+    timestamps -= timestamps[0]
+
+    return selection, pixel_size, timestamps, values[:len(timestamps)]
+
+
+def load_cells(path, filenames, selections, cells):
+    """
+    Puts the loaded cells (filename, cell, error) into the queue cells, blocks while the queue is full and ends with None.
+    """
+    for filename in filenames:
+        try:
+            cells.put((filename, load_cell(path, filename, selections), None))
+        except Exception:
+            cells.put((filename, None, traceback.format_exc()))
+
+    cells.put(None)
+
+
+def fit_cell(path, filename, cell):
+    """
+    Fits a loaded cell, returns its row in diffusion-coefficients.csv.
+    """
+    selection, pixel_size, timestamps, values = cell
+    base_path = os.path.join(path, filename[:-4])
+    print('fit %s' % filename)
+
+    result = heat_diffusion_fit.analyze(pixel_size, timestamps, values, heat_diffusion_fit.Stopwatch(dict()))
+
+    if not persist:
+        return (result['diffusion_coef'], result['diffusion_coef_error'], '', '', '', result['high_res_delta_x'],
+                result['high_res_delta_t'], os.path.basename(base_path), result['confidence_lower'], result['confidence_upper'])
+
+    frap_headless.write_kymograph(base_path + '-values.csv', values, timestamps, pixel_size)
+    row = heat_diffusion_fit.write_results(base_path, result)
+
+    if render:
+        render_cell(base_path, row)
+
+    return row
+
+
+def render_cell(base_path, row):
+    plotting = importlib.import_module('plotting_arrays_002')
+
+    directory, cid = os.path.split(base_path)
+    D_coe = np.format_float_scientific((10 ** 12) * row[0], precision=2)
+    D_err = np.format_float_scientific((10 ** 12) * row[1], precision=2)
+
+    plotting.render_cell(directory, cid, plotting.report_text(cid, D_coe, D_err), base_path + '-graphs.png', base_path + '-graphs.pdf', 72 if plotting.preview else 300)
+
+
+def write_selections(selections_path, selections):
+    with open(selections_path, 'w') as f:
+        f.write('%20s, %10s, %10s, %10s, %10s, %10s, %10s, %10s\n' % ('filename', 'photo_bleached', 'background', 'x1', 'y1', 'x2', 'y2', 'aspect_ratio'))
+        for selection in selections:
+            f.write('%20s, %10d, %10.3f, %10.3f, %10.3f, %10.3f, %10.3f, %10.3f\n' % selection)
+
+
+def process_all(path):
+    filenames = sorted(filename for filename in os.listdir(path) if filename.endswith('.lsm'))
+    selections_path = os.path.join(path, 'selections.csv')
+    selections = dict()
+
+    if os.path.exists(selections_path):
+        selections = {selection[0]: selection for selection in frap_headless.read_selections(selections_path)}
+
+    print('%d files, %d with a selection in selections.csv' % (len(filenames), len(set(filenames) & set(selections))))
+
+    cells = queue.Queue(queue_size)
+    loader = threading.Thread(target=load_cells, args=(path, filenames, selections, cells), daemon=True)
+    loader.start()
+
+    results = list()
+    failed = list()
+
+    for filename, cell, error in iter(cells.get, None):
+        if error is None:
+            try:
+                results.append(fit_cell(path, filename, cell))
+                selections[filename] = cell[0]
+            except Exception:
+                error = traceback.format_exc()
+
+        if error is not None:
+            print('processing %s failed\n%s' % (filename, error))
+            failed.append(filename)
+
+    loader.join()
+
+    heat_diffusion_fit.write_summary(path, results)
+
+    if persist:
+        write_selections(selections_path, [selections[filename] for filename in sorted(selections)])
+
+    print('%d cells processed, %d failed' % (len(filenames) - len(failed), len(failed)))
+    for filename in failed:
+        print('  %s' % filename)
+
+
+if __name__ == '__main__':
+    process_all(path)
@@ -0,0 +1,78 @@
+"""
+Binary storage of the kymographs of a cell. All arrays of a cell are stored as .npy files in one directory
+(<cell>-arrays), next to the csv files. Every file can be memory mapped, so readers only load the arrays they use.
+
+    values, simulated, residuals                    t x n, with axes time and distance
+    simulated-high-res, residuals-high-res          t x n, with axes time-high-res and distance-high-res
+"""
+
+import os
+import shutil
+
+import numpy as np
+
+axes = {
+    'values': ('time', 'distance'),
+    'simulated': ('time', 'distance'),
+    'residuals': ('time', 'distance'),
+    'simulated-high-res': ('time-high-res', 'distance-high-res'),
+    'residuals-high-res': ('time-high-res', 'distance-high-res'),
+}
+
+
+def bundle_path(base_path):
+    """
+    base_path is the path of the cell without suffix, e.g. 'data/1_cell' for 'data/1_cell-values.csv'
+    """
+    return base_path + '-arrays'
+
+
+def has_bundle(base_path, name='values'):
+    return os.path.exists(os.path.join(bundle_path(base_path), name + '.npy'))
+
+
+def write_bundle(base_path, **arrays):
+    """
+    Writes arrays (by name, e.g. values=..., time=...) into the bundle of a cell. Existing arrays are replaced.
+    Single precision arrays stay single precision, everything else is stored as double precision.
+    """
+    path = bundle_path(base_path)
+    os.makedirs(path, exist_ok=True)
+
+    for name, array in arrays.items():
+        single = getattr(array, 'dtype', None) == np.float32
+        np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(array, dtype=np.float32 if single else float))
+
+    return path
+
+
+def remove_bundle(base_path, names=None):
+    """
+    Removes arrays (by name) from the bundle of a cell, or the whole bundle when names is None.
+    """
+    path = bundle_path(base_path)
+
+    if names is None:
+        shutil.rmtree(path, ignore_errors=True)
+        return
+
+    for name in names:
+        try:
+            os.remove(os.path.join(path, name + '.npy'))
+        except FileNotFoundError:
+            pass
+
+
+def read_array(base_path, name):
+    """
+    Memory maps one array of the bundle of a cell.
+    """
+    return np.load(os.path.join(bundle_path(base_path), name + '.npy'), mmap_mode='r')
+
+
+def read_kymograph(base_path, name):
+    """
+    Memory maps a kymograph together with its axes, returns (distance, time, values).
+    """
+    time, distance = axes[name]
+    return read_array(base_path, distance), read_array(base_path, time), read_array(base_path, name)
@@ -0,0 +1,104 @@
+"""
+Reads Zeiss .lsm stacks (TIFF based) in CPython, without Fiji and Bio-Formats, so the automatic steps of the analysis
+can run with NumPy on headless machines (see frap_headless.py). The Fiji scripts stay for adjusting the selections.
+
+The frames of a channel are memory mapped straight from the file when the image data is uncompressed, so only the
+pixels that are used are read. Time stamps (s) and pixel size (µm) are the TimeStamp and VoxelSizeX values Bio-Formats
+reports in Fiji.
+"""
+
+import numpy as np
+import tifffile
+
+transmitted_channel = 'T PMT'   # the transmitted light channel, the first other channel is analyzed
+
+
+def channel_names(lsm_metadata, channels):
+    """
+    Returns the names of the channels of a stack, from the data channels of the scan information or, when these
+    don't match the number of channels, from the channel colors. Returns empty names when neither is available.
+    """
+    scan_information = lsm_metadata.get('ScanInformation', {})
+    names = [channel.get('Name', '') for track in scan_information.get('Tracks', []) for channel in track.get('DataChannels', [])]
+
+    if len(names) != channels:
+        names = list(lsm_metadata.get('ChannelColors', {}).get('ColorNames', []))
+
+    if len(names) != channels:
+        names = [''] * channels
+
+    return names
+
+
+def select_channel(lsm_metadata, channels):
+    """
+    Returns the first channel that is not the transmitted light channel.
+    """
+    for channel, name in enumerate(channel_names(lsm_metadata, channels)):
+        if not name.startswith(transmitted_channel):
+            return channel
+
+    return 0
+
+
+def map_channel(path, tif, channel):
+    """
+    Returns one channel of all frames of the first series as a (frames, height, width) array.
+    LSM files interleave the frames with thumbnails, so the frames are mapped with a stride between frames. When the
+    frames are compressed or not equally spaced the channel is read into memory.
+    """
+    pages = tif.series[0].pages
+    keyframe = tif.series[0].keyframe
+    height, width, samples = keyframe.imagelength, keyframe.imagewidth, keyframe.samplesperpixel
+    dtype = np.dtype(keyframe.dtype).newbyteorder(tif.byteorder)
+    offsets = np.array([page.dataoffsets[0] for page in pages], dtype=np.int64)
+
+    if keyframe.is_contiguous and (len(offsets) == 1 or np.all(np.diff(offsets) == offsets[1] - offsets[0])):
+        frame_stride = int(offsets[1] - offsets[0]) if len(offsets) > 1 else 0
+
+        if keyframe.planarconfig == 1 and samples > 1:
+            # samples of a pixel are stored next to each other
+            offset = int(offsets[0]) + channel * dtype.itemsize
+            strides = (frame_stride, width * samples * dtype.itemsize, samples * dtype.itemsize)
+        else:
+            # every channel is stored as a separate plane
+            offset = int(offsets[0]) + channel * height * width * dtype.itemsize
+            strides = (frame_stride, width * dtype.itemsize, dtype.itemsize)
+
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        return np.ndarray((len(offsets), height, width), dtype=dtype, buffer=data, offset=offset, strides=strides)
+
+    frames = np.stack([page.asarray() for page in pages])
+    if samples == 1:
+        return frames
+    elif keyframe.planarconfig == 1:
+        return frames[..., channel]
+    else:
+        return frames[:, channel]
+
+
+def read_metadata(tif):
+    """
+    Returns the time stamps (s) of the frames and the pixel size (µm).
+    """
+    lsm_metadata = tif.lsm_metadata
+    timestamps = [float(t) for t in lsm_metadata.get('TimeStamps', [])]
+    pixel_size = float(lsm_metadata['VoxelSizeX']) * 1e6
+
+    return timestamps, pixel_size
+
+
+def open_image(path):
+    """
+    Opens an .lsm stack and returns the frames of the first channel that is not the transmitted light channel
+    (frames x height x width, memory mapped when possible), the time stamps (s) and the pixel size (µm).
+    """
+    with tifffile.TiffFile(path) as tif:
+        if not tif.is_lsm:
+            raise ValueError('%s is not an LSM file' % path)
+
+        channel = select_channel(tif.lsm_metadata, tif.series[0].keyframe.samplesperpixel)
+        frames = map_channel(path, tif, channel)
+        timestamps, pixel_size = read_metadata(tif)
+
+    return frames, timestamps, pixel_size
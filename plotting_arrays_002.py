@@ -3,189 +3,349 @@ from matplotlib import pyplot as plt
 from matplotlib import cm
 from matplotlib.backends.backend_pdf import PdfPages
 import os
+import json
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
+import kymograph_arrays
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
 path = os.getcwd()
 #path = 'g:\\My Drive\\Data\\PyCharmProjects\\New FRAP analysis software\\20190116 - testing new vs old supercharged data\\eco fast\\0\\20160310\\'
-print('Processing directory:\n%s ...' % path)
 
-f_d = os.listdir(path)
+recursive = True        # also report the cells in all subdirectories of path
+incremental = True      # only render cells whose kymographs or coefficient changed, allcells.pdf is assembled from the
+                        # cached per cell pages (<cell>-graphs.pdf), this needs pypdf
+workers = os.cpu_count()    # cells rendered in parallel (needs pypdf), 1 renders all cells in this process
+preview = False             # quick low resolution report (72 instead of 300 dpi) for triage
+
+report = None           # the report figure of this process, created by the first cell it renders
+
+
+def index_cells(path):
+    """
+    Indexes all cells in a single pass over path (and its subdirectories).
+    Returns {(directory, cell id): set of outputs} (e.g. {'values.csv', 'simulated.csv', 'arrays'}) and
+    {(summary directory, cell id): (diffusion coefficient, error)} from all diffusion-coefficients.csv files found, or
+    None when there are none. Cells that appear more than once in a summary are reported and left out.
+    """
+    cells = dict()
+    coefficients = None
+    duplicates = set()
+
+    for directory, directories, filenames in os.walk(path):
+        for name in directories + filenames:
+            if name[0].isdigit() and '-' in name and (name.endswith('.csv') or name.endswith('-arrays')):
+                cid, output = name.split('-', 1)
+                cells.setdefault((directory, cid), set()).add(output)
+
+        if 'diffusion-coefficients.csv' in filenames:
+            table = pd.read_csv(os.path.join(directory, 'diffusion-coefficients.csv'), dtype={'cell_id': str})
+            if coefficients is None:
+                coefficients = dict()
+            for cid, d, e in zip(table['cell_id'], table['diffusion_coefficient'], table['diffusion_coefficient_error']):
+                if (directory, cid) in duplicates:
+                    continue
+                elif (directory, cid) in coefficients:
+                    print('##\n## %s appears more than once in %s, its coefficient is not used\n##' % (cid, os.path.join(directory, 'diffusion-coefficients.csv')))
+                    del coefficients[(directory, cid)]
+                    duplicates.add((directory, cid))
+                else:
+                    coefficients[(directory, cid)] = (d, e)
+
+        directories[:] = sorted(d for d in directories if not d.endswith('-arrays')) if recursive else []
+
+    return cells, coefficients
+
+
+def find_coefficient(coefficients, directory, cid):
+    """
+    Looks up the coefficient of a cell in the summary of its directory or, for a summary of the whole tree, of a
+    parent directory. A summary lists the cell by its path relative to the summary (e.g. 'day1/1_cell'). When several
+    summaries list the cell (e.g. after switching between a summary per directory and one of the whole tree), the most
+    recently written one is used.
+    """
+    found = list()
+    summary_directory = directory
+
+    while True:
+        cell_id = os.path.relpath(os.path.join(directory, cid), summary_directory).replace(os.sep, '/')
+        if (summary_directory, cell_id) in coefficients:
+            found.append((os.path.getmtime(os.path.join(summary_directory, 'diffusion-coefficients.csv')), summary_directory, cell_id))
+        if os.path.normpath(summary_directory) == os.path.normpath(path) or os.path.dirname(summary_directory) == summary_directory:
+            break
+        summary_directory = os.path.dirname(summary_directory)
+
+    if not found:
+        raise KeyError(cid)
+
+    modified, summary_directory, cell_id = max(found)
+    return coefficients[(summary_directory, cell_id)]
+
+
+def sort_key(cell):
+    """
+    Sorts cells by directory, then by the numbers in the cell id (so 2_cell comes before 10_cell).
+    """
+    directory, cid = cell
+    return directory, [int(t) for t in cid.split('_') if t.isdigit()], cid
+
+
+def input_files(directory, cid, outputs):
+    """
+    The files a cell's report is drawn from (csv files and the .npy files of its bundle).
+    """
+    for output in outputs:
+        if output == 'arrays':
+            yield from (entry.path for entry in os.scandir(os.path.join(directory, '%s-arrays' % cid)) if entry.name.endswith('.npy'))
+        else:
+            yield os.path.join(directory, '%s-%s' % (cid, output))
+
+
+def is_up_to_date(outputs, inputs):
+    """
+    True if all outputs exist and none of the inputs was modified after the oldest output.
+    """
+    try:
+        oldest = min(os.path.getmtime(output) for output in outputs)
+    except FileNotFoundError:
+        return False
 
+    return all(os.path.getmtime(i) <= oldest for i in inputs)
 
-cell_names = []
-cell_ids = []
 
-try:
-    Ds_table = pd.read_csv(os.path.join(path, 'diffusion-coefficients.csv')).astype({'cell_id': str})
-except FileNotFoundError:
-    Ds_table = ''
-    print \
-        ('#############################################\n####diffusion-coefficients.csv not found!####\n#############################################')
-#print(Ds_table['cell_id'])
-#print(Ds_table['diffusion_coefficient'])
+def read_report_cache(path):
+    try:
+        with open(os.path.join(path, 'report-cache.json'), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return dict()
 
 
-for f in f_d:
-    if f.endswith('.csv') and f[0].isdigit():
-        # print(f)
-        cell_name = f.split('-')[0]
-        cell_names.append(cell_name)
+def write_report_cache(path, report_cache):
+    with open(os.path.join(path, 'report-cache.json'), 'w') as f:
+        json.dump(report_cache, f, indent=1, sort_keys=True)
 
-        for t in cell_name.split('_'):
-            # print(int(t))
-            try:
-                cell_ids.append(int(t))
-            except ValueError:
-                pass
 
+def report_text(cid, D_coe, D_err):
+    return 'Cell name - %s\n' r'$D_t$ - %s $(µm^2)/s$' '\n' r'Error - %s' % (cid, D_coe, D_err)
 
-cell_ids = list(set(cell_ids))
-cell_ids.sort()
 
+def read_kymograph(directory, cid, name):
+    """
+    Returns the grids x (length) and y (time) and the values z of a kymograph of a cell.
+    The binary bundle is memory mapped when the fit wrote one (and it isn't older than the csv file, then it's left
+    from an earlier run), otherwise the csv file is read.
+    """
+    base_path = os.path.join(directory, cid)
+    csv_path = os.path.join(directory, '%s-%s.csv' % (cid, name))
+    array_path = os.path.join(kymograph_arrays.bundle_path(base_path), name + '.npy')
 
+    if os.path.exists(array_path) and not (os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(array_path)):
+        x, y, z = kymograph_arrays.read_kymograph(base_path, name)
+    else:
+        table = pd.read_csv(csv_path)
+        z = np.asarray(table.iloc[0:, 1:], dtype=float)
+        x = np.asarray(table.columns.values[1:], dtype=float)
+        y = np.asarray(table.iloc[:, 0].values, dtype=float)
 
+    x, y = np.meshgrid(x, y)
+    return x, y, z
 
-print('There are %s cells to analyze.' % len(cell_ids))
 
-# print(cell_ids)
-pdf = PdfPages('allcells.pdf')
-for cid_int in cell_ids:
+x_ax_label = 'Length [µm]'
+y_ax_label = 'Time [s]'
 
-    for name in cell_names:
-        if name.startswith(str(cid_int)):
-            cid = name
-    #print(cid)
-    #print(type(cid))
-    #print(Ds_table['cell_id'])
-    #print(type(Ds_table['cell_id']))
-    print('Processing %s...' % cid)
-    #print(Ds_table['cell_id'] == cid)
-    #print(Ds_table.loc[Ds_table['cell_id'] == cid, 'diffusion_coefficient'].iloc[0])
+# kymograph panels of the report: name, subplot, title and colormap
+kymograph_panels = [
+    ('values', 1, 'Experimental values', cm.magma),
+    ('simulated', 3, '1D Heat Equation Simulation', cm.magma),
+    ('residuals', 5, 'Residuals', cm.PuOr_r),
+    ('simulated-high-res', 4, 'HR 1D Heat Equation Simulation', cm.magma),
+    ('residuals-high-res', 6, 'HR Residuals', cm.PuOr_r),
+]
 
 
-    file_not_found = 0
-    not_in_table = 0
-    try:
+def create_report_figure():
+    """
+    Creates the report figure once. Every cell draws its kymographs into the same axes and colorbars, so memory
+    doesn't grow with the number of cells.
+    Returns the figure, the panels ([axes, mesh, colorbar] by kymograph name) and the text with the cell's coefficient.
+    """
+    fig = plt.figure(figsize=(7, 8))
+    panels = dict()
 
-        D_coe = np.format_float_scientific \
-            ((10 ** 12) * (Ds_table.loc[Ds_table['cell_id'] == cid, 'diffusion_coefficient'].iloc[0]), precision=2)
-        D_err = np.format_float_scientific \
-            ((10 ** 12) * (Ds_table.loc[Ds_table['cell_id'] == cid, 'diffusion_coefficient_error'].iloc[0]), precision=2)
-    except IndexError:
-        not_in_table = 1
-        D_coe = 'not found'
-        D_err = 'not found'
-        print('##\n## %s not in table! \n##' % cid)
-    except AttributeError:
-        D_coe = 'no file'
-        D_err = 'no file'
+    for name, position, title, cmap in kymograph_panels:
+        ax = fig.add_subplot(3, 2, position)
+        ax.set_title(title)
+        ax.set_ylabel(y_ax_label)
+        ax.set_xlabel(x_ax_label)
 
+        mesh = ax.pcolormesh(np.zeros((2, 2)), cmap=cmap, rasterized=True)
+        panels[name] = [ax, mesh, fig.colorbar(mesh, ax=ax)]
 
-    try:
-        g_val = pd.read_csv(os.path.join(path, '%s-values.csv' % cid))
-        g_sim = pd.read_csv(os.path.join(path, '%s-simulated.csv' % cid))
-        g_res = pd.read_csv(os.path.join(path, '%s-residuals.csv' % cid))
-        g_sim_hr = pd.read_csv(os.path.join(path, '%s-simulated-high-res.csv' % cid))
-        g_res_hr = pd.read_csv(os.path.join(path, '%s-residuals-high-res.csv' % cid))
-    except FileNotFoundError:
-        file_not_found = 1
+    ax = fig.add_subplot(3, 2, 2)
+    text = ax.text(0, 0.6, '', fontsize=14)
+    ax.text(0, 0, '\n\nValues make sense only\nif the model fits the data!\nCheck the residuals!\n\nIf the model fits,\nerror is standard deviation.', fontsize=10)
+    ax.axis('off')
 
+    return fig, panels, text
 
 
+def draw_kymograph(panel, x, y, z):
+    """
+    Replaces the kymograph of a panel. pcolormesh draws one mesh (rasterized in the pdf) instead of a polygon per pixel.
+    """
+    ax, mesh, colorbar = panel
+    mesh.remove()
 
-    if file_not_found == 0:
+    mesh = ax.pcolormesh(x, y, z, cmap=colorbar.cmap, shading='nearest', rasterized=True)
+    colorbar.update_normal(mesh)
 
+    coordinates = mesh.get_coordinates()
+    ax.set_xlim(coordinates[..., 0].min(), coordinates[..., 0].max())
+    ax.set_ylim(coordinates[..., 1].min(), coordinates[..., 1].max())
+    ax.set_visible(True)
+    colorbar.ax.set_visible(True)
 
-        z_g_val = np.asarray(g_val.iloc[0:, 1:], dtype=np.float)
-        x_g_val = np.asarray(g_val.columns.values[1:], dtype=np.float)
-        y_g_val = np.asarray(g_val.iloc[:, 0].values, dtype=np.float)
+    panel[1] = mesh
 
-        x_g_val, y_g_val = np.meshgrid(x_g_val, y_g_val)
 
-        z_g_sim = np.asarray(g_sim.iloc[0:, 1:], dtype=np.float)
-        x_g_sim = np.asarray(g_sim.columns.values[1:], dtype=np.float)
-        y_g_sim = np.asarray(g_sim.iloc[:, 0].values, dtype=np.float)
+def hide_kymograph(panel):
+    ax, mesh, colorbar = panel
+    ax.set_visible(False)
+    colorbar.ax.set_visible(False)
 
-        x_g_sim, y_g_sim = np.meshgrid(x_g_sim, y_g_sim)
 
-        z_g_res = np.asarray(g_res.iloc[0:, 1:], dtype=np.float)
-        x_g_res = np.asarray(g_res.columns.values[1:], dtype=np.float)
-        y_g_res = np.asarray(g_res.iloc[:, 0].values, dtype=np.float)
+def render_cell(directory, cid, text, png_path, page_path, dpi, pdf=None):
+    """
+    Renders the report of a cell into its png and its pdf page (or into pdf, when given).
+    Every process draws into its own report figure. Returns False when the kymographs of the cell are missing.
+    """
+    global report
+    if report is None:
+        report = create_report_figure()
+    report_figure, report_panels, report_text = report
 
-        x_g_res, y_g_res = np.meshgrid(x_g_res, y_g_res)
+    try:
+        x_g_val, y_g_val, z_g_val = read_kymograph(directory, cid, 'values')
+        x_g_sim, y_g_sim, z_g_sim = read_kymograph(directory, cid, 'simulated')
+        x_g_res, y_g_res, z_g_res = read_kymograph(directory, cid, 'residuals')
+    except FileNotFoundError:
+        print('Files for %s missing!' % cid)
+        return False
 
-        z_g_sim_hr = np.asarray(g_sim_hr.iloc[0:, 1:], dtype=np.float)
-        x_g_sim_hr = np.asarray(g_sim_hr.columns.values[1:], dtype=np.float)
-        y_g_sim_hr = np.asarray(g_sim_hr.iloc[:, 0].values, dtype=np.float)
+    draw_kymograph(report_panels['values'], x_g_val, y_g_val, z_g_val)
+    draw_kymograph(report_panels['simulated'], x_g_sim, y_g_sim, z_g_sim)
+    draw_kymograph(report_panels['residuals'], x_g_res, y_g_res, z_g_res)
 
-        x_g_sim_hr, y_g_sim_hr = np.meshgrid(x_g_sim_hr, y_g_sim_hr)
+    # the high resolution simulation is optional (see high_resolution in 1d_heat_diff_fit.py)
+    try:
+        x_g_sim_hr, y_g_sim_hr, z_g_sim_hr = read_kymograph(directory, cid, 'simulated-high-res')
+        x_g_res_hr, y_g_res_hr, z_g_res_hr = read_kymograph(directory, cid, 'residuals-high-res')
+        draw_kymograph(report_panels['simulated-high-res'], x_g_sim_hr, y_g_sim_hr, z_g_sim_hr)
+        draw_kymograph(report_panels['residuals-high-res'], x_g_res_hr, y_g_res_hr, z_g_res_hr)
+    except FileNotFoundError:
+        hide_kymograph(report_panels['simulated-high-res'])
+        hide_kymograph(report_panels['residuals-high-res'])
 
-        z_g_res_hr = np.asarray(g_res_hr.iloc[0:, 1:], dtype=np.float)
-        x_g_res_hr = np.asarray(g_res_hr.columns.values[1:], dtype=np.float)
-        y_g_res_hr = np.asarray(g_res_hr.iloc[:, 0].values, dtype=np.float)
+    report_text.set_text(text)
 
-        x_g_res_hr, y_g_res_hr = np.meshgrid(x_g_res_hr, y_g_res_hr)
+    report_figure.tight_layout()
+    report_figure.savefig(png_path, dpi=dpi)
 
-        x_ax_label = 'Length [µm]'
-        y_ax_label = 'Time [s]'
+    if pdf is None:
+        report_figure.savefig(page_path, dpi=dpi)
+    else:
+        pdf.savefig(report_figure, dpi=dpi)
 
-        fig, ax = plt.subplots(figsize=(7, 8))
-        # ax = fig.add_subplot(1,1,1)
-        # ax.set_ylabel('Time [s]')
-        # ax.set_xlabel('Length [um]')
-        plt.set_cmap(cm.magma)
-        fig.gca()
+    print('%s done!' % cid)
+    return True
 
-        plt.subplot(3, 2, 1)
-        plt.pcolor(x_g_val, y_g_val, z_g_val)
-        plt.colorbar()
-        plt.ylabel(y_ax_label)
-        plt.xlabel(x_ax_label)
-        plt.title('Experimental values')
 
-        plt.subplot(3, 2, 3)
-        plt.pcolor(x_g_sim, y_g_sim, z_g_sim)
-        plt.colorbar()
-        plt.ylabel(y_ax_label)
-        plt.xlabel(x_ax_label)
-        plt.title('1D Heat Equation Simulation')
+if __name__ == '__main__':
+    print('Processing directory:\n%s ...' % path)
 
-        plt.subplot(3, 2, 5)
-        plt.pcolor(x_g_res, y_g_res, z_g_res, cmap=cm.PuOr_r)
-        plt.colorbar()
-        plt.ylabel(y_ax_label)
-        plt.xlabel(x_ax_label)
-        plt.title('Residuals')
+    cell_outputs, coefficients = index_cells(path)
+    cells = sorted(cell_outputs, key=sort_key)
 
-        plt.subplot(3, 2, 4)
-        plt.pcolor(x_g_sim_hr, y_g_sim_hr, z_g_sim_hr)
-        plt.colorbar()
-        plt.ylabel(y_ax_label)
-        plt.xlabel(x_ax_label)
-        plt.title('HR 1D Heat Equation Simulation')
+    if coefficients is None:
+        print \
+            ('#############################################\n####diffusion-coefficients.csv not found!####\n#############################################')
 
-        plt.subplot(3, 2, 6)
-        plt.pcolor(x_g_res_hr, y_g_res_hr, z_g_res_hr, cmap=cm.PuOr_r)
-        plt.colorbar()
-        plt.ylabel(y_ax_label)
-        plt.xlabel(x_ax_label)
-        plt.title('HR Residuals')
 
-        plt.subplot(3, 2, 2)
-        plt.text(0, 0.6, 'Cell name - %s\n' r'$D_t$ - %s $(µm^2)/s$' '\n' r'Error - %s' % (cid, D_coe, D_err), fontsize=14)
-        plt.text(0, 0, '\n\nValues make sense only\nif the model fits the data!\nCheck the residuals!\n\nIf the model fits,\nerror is standard deviation.', fontsize=10)
-        plt.axis('off')
+    print('There are %s cells to analyze.' % len(cells))
 
+    if PdfWriter is None:
+        print('pypdf is not installed, all cells are rendered in this process')
 
-        plt.tight_layout()
-        pdf.savefig()
-        plt.savefig(os.path.join(path, '%s-graphs.png' % cid), dpi=300)
+    dpi = 72 if preview else 300
+    report_cache = read_report_cache(path)
 
-        print('%s done!' % cid)
+    # with pypdf every cell is also saved as a single pdf page, allcells.pdf is assembled from these pages at the end
+    pages = list()
+    jobs = list()
+    for directory, cid in cells:
 
-    else:
+        print('Processing %s...' % os.path.relpath(os.path.join(directory, cid), path))
 
-        print('Files for %s missing!' % cid)
 
-pdf.close()
-print('all done!')
\ No newline at end of file
+        try:
+            diffusion_coefficient, diffusion_coefficient_error = find_coefficient(coefficients, directory, cid)
+            D_coe = np.format_float_scientific((10 ** 12) * diffusion_coefficient, precision=2)
+            D_err = np.format_float_scientific((10 ** 12) * diffusion_coefficient_error, precision=2)
+        except KeyError:
+            D_coe = 'not found'
+            D_err = 'not found'
+            print('##\n## %s not in table! \n##' % cid)
+        except TypeError:
+            D_coe = 'no file'
+            D_err = 'no file'
+
+
+        text = report_text(cid, D_coe, D_err)
+        png_path = os.path.join(directory, '%s-graphs.png' % cid)
+        page_path = os.path.join(directory, '%s-graphs.pdf' % cid)
+
+        # the report of this cell doesn't need to be rendered again
+        if incremental and PdfWriter and report_cache.get(os.path.relpath(png_path, path)) == [text, dpi] and is_up_to_date([png_path, page_path], input_files(directory, cid, cell_outputs[(directory, cid)])):
+            pages.append(page_path)
+            print('%s up to date' % cid)
+            continue
+
+        jobs.append((directory, cid, text, png_path, page_path, dpi))
+        pages.append(page_path)
+
+    if PdfWriter is None:
+        pdf = PdfPages('allcells.pdf')
+        rendered = [render_cell(*job, pdf=pdf) for job in jobs]
+        pdf.close()
+    elif workers > 1 and len(jobs) > 1:
+        # headless workers, every worker renders whole cells into its own figure
+        with ProcessPoolExecutor(min(workers, len(jobs)), initializer=plt.switch_backend, initargs=('agg',)) as executor:
+            rendered = list(executor.map(render_cell, *zip(*jobs)))
+    else:
+        rendered = [render_cell(*job) for job in jobs]
+
+    if report is not None:
+        plt.close(report[0])
+
+    for (directory, cid, text, png_path, page_path, dpi), done in zip(jobs, rendered):
+        if done:
+            report_cache[os.path.relpath(png_path, path)] = [text, dpi]
+        else:
+            pages.remove(page_path)
+
+    if PdfWriter is not None:
+        writer = PdfWriter()
+        for page_path in pages:
+            writer.append(page_path)
+        writer.write('allcells.pdf')
+        writer.close()
+
+    write_report_cache(path, report_cache)
+    print('all done! (%d of %d cells rendered)' % (sum(rendered), len(cells)))
\ No newline at end of file